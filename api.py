@@ -1,18 +1,59 @@
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Iterable, List, Optional
+import asyncio
+import atexit
+import bisect
+import contextvars
+import functools
+import importlib
+import json
+import math
+import os
+import random
 import sqlite3
 import time
+import zoneinfo
 from datetime import datetime, timedelta
-import yfinance as yf
 import hashlib
+import mmap
 import secrets
+import struct
 from passlib.context import CryptContext # For password hashing
 from jose import JWTError, jwt # For JWT
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm # For auth flow
 from fastapi import Depends, status # For dependency injection and status codes
-import traceback # Import traceback for detailed error logging
+import logging
+import logging.handlers
+import queue
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+class LazyModule:
+    """Stands in for a heavy module and imports it on first attribute access. yfinance alone (which pulls
+    in pandas, numpy and requests) is most of this app's import time, and only the fetchers and
+    /analytics need these modules."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+yf = LazyModule("yfinance")
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
 
 # --- Configuration ---
 SECRET_KEY = secrets.token_hex(32) # Replace with a strong, persistent key in production
@@ -25,17 +66,47 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login") # Points to the /login endpoint
 
-# Gold price cache
-gold_price_cache = None
-gold_price_last_updated = None
-
-# Silver price cache
-silver_price_cache = None
-silver_price_last_updated = None
-
-# Palladium price cache
-palladium_price_cache = None
-palladium_price_last_updated = None
+# Commodity registry: every instrument the API serves, keyed by the name used in URLs and responses.
+# Extra instruments can be added without code changes through the EXTRA_COMMODITIES environment variable,
+# e.g. EXTRA_COMMODITIES='{"aluminium": {"symbol": "ALI=F", "unit": "per metric ton"}}'. An optional "calendar"
+# names the TRADING_CALENDARS entry its refresh schedule follows (default: cme_globex for "=F" futures, else always).
+COMMODITIES = {
+    "gold": {"symbol": "GC=F", "unit": "per troy ounce"},
+    "silver": {"symbol": "SI=F", "unit": "per troy ounce"},
+    "palladium": {"symbol": "PA=F", "unit": "per troy ounce"},
+    "platinum": {"symbol": "PL=F", "unit": "per troy ounce"},
+    "copper": {"symbol": "HG=F", "unit": "per pound"},
+}
+COMMODITIES.update(json.loads(os.environ.get("EXTRA_COMMODITIES", "{}")))
+SYMBOL_TO_COMMODITY = {spec["symbol"]: name for name, spec in COMMODITIES.items()}
+
+# Currencies prices can be quoted in. Upstream quotes are in USD; the others are converted with FX rates
+# fetched alongside the metals, as Yahoo's "<CUR>=X" tickers (units of that currency per US dollar).
+PRICE_CURRENCIES = ("USD", "EUR", "GBP", "CHF", "JPY", "CNY", "INR", "AED", "CAD", "AUD")
+FX_SYMBOLS = {currency: f"{currency}=X" for currency in PRICE_CURRENCIES if currency != "USD"}
+# Mass units prices can be quoted per: query parameter value -> (label used in responses, grams)
+PRICE_UNITS = {
+    "troy_ounce": ("per troy ounce", 31.1034768),
+    "gram": ("per gram", 1.0),
+    "kilogram": ("per kilogram", 1000.0),
+    "tola": ("per tola", 11.6638038),
+    "pound": ("per pound", 453.59237),
+}
+PRICE_UNIT_ALIASES = {"g": "gram", "kg": "kilogram", "oz": "troy_ounce", "ozt": "troy_ounce", "lb": "pound"}
+
+# Price cache: commodity name -> {"price": float, "last_updated": datetime, "source": provider source name, ...}
+price_cache = {}
+
+# Background price refresher
+PRICE_REFRESH_INTERVAL_SECONDS = 60 # Base refresh interval; the adaptive schedule scales it per symbol
+PRICE_WARMUP_TIMEOUT_SECONDS = float(os.environ.get("PRICE_WARMUP_TIMEOUT_SECONDS", "15")) # Startup fetch budget, 0 = off
+PRICE_STALE_AFTER_INTERVALS = 2 # A served price is flagged stale once it is this many refresh intervals old
+price_refresh_in_progress = False
+price_refresher_task = None
+
+# Cross-worker price cache: when set (e.g. /dev/shm/commodity-prices), every uvicorn worker on the host
+# shares one memory-mapped price table and only the elected leader fetches upstream
+SHARED_PRICE_CACHE_PATH = os.environ.get("SHARED_PRICE_CACHE_PATH")
 
 app = FastAPI()
 
@@ -79,45 +150,946 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
-# Database setup
-def get_db_connection():
-    conn = sqlite3.connect('api_keys.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# --- Metrics ---
+# Prometheus text-format metrics, served at /metrics. Every counter and histogram keeps one shard of values
+# per thread (the event loop, the DB executor threads, ...). Only the owning thread writes to its shard, so
+# recording is a couple of dict lookups and an add, with no lock. A scrape sums the shards. Gauges and
+# counters that already exist elsewhere (pool, cache stats) are read from live state at scrape time.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") # When set, /metrics requires "Authorization: Bearer <token>"
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics_registry = []
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._shards = {} # thread id -> {label values: value}
+        metrics_registry.append(self)
+
+    def _shard(self) -> dict:
+        thread_id = threading.get_ident()
+        shard = self._shards.get(thread_id)
+        if shard is None:
+            shard = self._shards[thread_id] = {}
+        return shard
+
+    @abstractmethod
+    def samples(self):
+        """Yields (sample name, ((label, value), ...), number) for the exposition format."""
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def samples(self):
+        totals = {}
+        for shard in list(self._shards.values()):
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in totals.items():
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: tuple = ()):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None: # One count per bucket plus +Inf, then the running sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        totals = {}
+        for shard in list(self._shards.values()):
+            for labels, counts in list(shard.items()):
+                total = totals.setdefault(labels, [0] * len(counts))
+                for index, count in enumerate(counts):
+                    total[index] += count
+        for labels, counts in totals.items():
+            label_pairs = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield self.name + "_bucket", label_pairs + (("le", le),), cumulative
+            yield self.name + "_sum", label_pairs, counts[-1]
+            yield self.name + "_count", label_pairs, cumulative
+
+class CollectedMetric(Metric):
+    """Values computed at scrape time by collect() -> {label values: number}."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, collect, type: str = "gauge"):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name, tuple(zip(self.labelnames, labels)), value
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for sample_name, label_pairs, value in metric.samples():
+            labels = ",".join(f'{label}="{_escape_label_value(label_value)}"' for label, label_value in label_pairs)
+            lines.append(f"{sample_name}{{{labels}}} {float(value)!r}" if labels else f"{sample_name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+http_requests_total = Counter("http_requests_total", "HTTP requests by method, route template and status.", ("method", "route", "status"))
+http_request_duration_seconds = Histogram("http_request_duration_seconds", "HTTP request latency by method and route template.", ("method", "route"))
+auth_failures_total = Counter("auth_failures_total", "Rejected authentication attempts by kind.", ("kind",))
+price_cache_lookups_total = Counter("price_cache_lookups_total", "Price snapshot lookups by symbol and result (hit or miss).", ("symbol", "result"))
+price_cache_age_seconds = CollectedMetric(
+    "price_cache_age_seconds", "Age of the cached price snapshot by symbol.", ("symbol",),
+    lambda: {(COMMODITIES[name]["symbol"],): price_age_seconds(snapshot) for name, snapshot in list(price_cache.items())}
+)
+upstream_fetch_duration_seconds = Histogram(
+    "upstream_fetch_duration_seconds", "Latency of successful upstream price fetches by provider and symbol.", ("provider", "symbol"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+upstream_fetch_errors_total = Counter(
+    "upstream_fetch_errors_total", "Upstream price fetch failures by provider, symbol and kind (error, timeout, missing).",
+    ("provider", "symbol", "kind")
+)
+db_query_duration_seconds = Histogram("db_query_duration_seconds", "Time spent running SQLite work on a pooled connection.")
+db_pool_connections = CollectedMetric(
+    "db_pool_connections", "SQLite pool connections by state.", ("state",),
+    lambda: {("open",): db_pool.stats()["open_connections"], ("idle",): db_pool.stats()["idle_connections"]}
+)
+db_pool_waits_total = CollectedMetric(
+    "db_pool_waits_total", "Times a query had to wait for a free pooled connection.", (),
+    lambda: {(): db_pool.stats()["waits"]}, type="counter"
+)
+api_key_cache_lookups_total = CollectedMetric(
+    "api_key_cache_lookups_total", "API key cache lookups by result.", ("result",),
+    lambda: {("hit",): api_key_cache.stats()["hits"], ("miss",): api_key_cache.stats()["misses"]}, type="counter"
+)
+usage_events_pending = CollectedMetric(
+    "usage_events_pending", "API key usage events not yet flushed to the database.", (),
+    lambda: {(): usage_accumulator.stats()["pending_events"]}
+)
+upstream_circuit_state = CollectedMetric(
+    "upstream_circuit_state", "Circuit breaker state per price provider (1 for the current state).", ("provider", "state"),
+    lambda: {
+        (provider.name, state): int(provider.breaker.state == state)
+        for provider in price_providers for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)
+    }
+)
+price_refresh_interval_seconds = CollectedMetric(
+    "price_refresh_interval_seconds", "Current refresh interval of the adaptive schedule by symbol.", ("symbol",),
+    lambda: {(COMMODITIES[name]["symbol"],): refresh_schedule.interval(name) for name in COMMODITIES}
+)
+price_refreshes_total = CollectedMetric(
+    "price_refreshes_total", "Price snapshots refreshed by symbol.", ("symbol",),
+    lambda: {(COMMODITIES[name]["symbol"],): refresh_schedule.refreshes(name) for name in COMMODITIES},
+    type="counter"
+)
+price_stream_subscribers = CollectedMetric(
+    "price_stream_subscribers", "Open SSE/WebSocket price stream subscriptions.", (),
+    lambda: {(): price_broadcaster.stats()["subscribers"]}
+)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording request counts and latency per route template (not raw path, which
+    would give every API key and symbol its own series)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router records the matched route in the (shared) scope
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_requests_total.inc((scope["method"], route, str(status_code)))
+            http_request_duration_seconds.observe(time.perf_counter() - started, (scope["method"], route))
+
+app.add_middleware(MetricsMiddleware)
+
+# --- Logging ---
+# Structured logging that never blocks the event loop. Handlers only put the record on a bounded queue
+# (dropping and counting it when the queue is full). A QueueListener thread formats it (JSON lines by
+# default, LOG_FORMAT=text for humans) and writes it to stderr. High-volume messages pass
+# extra={"sample_every": N} to keep only every Nth record; structured data goes in extra={"fields": {...}}.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+REQUEST_ID_HEADER = "X-Request-ID"
+request_id_var = contextvars.ContextVar("request_id", default=None)
+logger = logging.getLogger("goldprice")
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "sample_every", None):
+            entry["sampled_1_in"] = record.sample_every
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extras = dict(getattr(record, "fields", None) or {})
+        if getattr(record, "request_id", None):
+            extras["request_id"] = record.request_id
+        if not extras:
+            return line
+        head, sep, tail = line.partition("\n") # Keep key=value pairs on the message line, before any traceback
+        return head + " " + " ".join(f"{key}={value}" for key, value in extras.items()) + sep + tail
+
+class LogContextFilter(logging.Filter):
+    """Runs in the calling thread: tags records with the current request ID and applies sampling."""
+
+    def __init__(self):
+        super().__init__()
+        self._sample_counts = {} # (logger, message template) -> records seen
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        every = getattr(record, "sample_every", None)
+        if every and every > 1:
+            key = (record.name, record.msg)
+            seen = self._sample_counts.get(key, 0)
+            self._sample_counts[key] = seen + 1
+            return seen % every == 0
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as-is, so message and traceback formatting happen there too."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage() # Freeze the arguments now, they may be mutated after this call returns
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_queue_handler.addFilter(LogContextFilter())
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(TextLogFormatter() if LOG_FORMAT == "text" else JSONLogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue_handler.queue, _log_stream_handler)
+logger.addHandler(log_queue_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_listener.start()
+atexit.register(log_listener.stop) # Drains whatever is still queued
+
+log_records_dropped_total = CollectedMetric(
+    "log_records_dropped_total", "Log records dropped because the logging queue was full.", (),
+    lambda: {(): log_queue_handler.dropped}, type="counter"
+)
+
+class RequestIDMiddleware:
+    """Gives every HTTP/WebSocket request an ID (the client's X-Request-ID, else a new one) for log records,
+    and echoes it in the response headers."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        header = REQUEST_ID_HEADER.lower().encode()
+        request_id = next((value.decode("latin-1") for name, value in scope["headers"] if name == header), None)
+        request_id = (request_id or secrets.token_hex(8))[:64]
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(header, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+app.add_middleware(RequestIDMiddleware)
+
+# --- Database Access Layer ---
+# All SQLite access goes through a small pool of long-lived connections (WAL journal, tuned pragmas,
+# per-connection prepared-statement cache). Async handlers run their queries on a bounded executor via
+# run_db / db_fetch_one / db_fetch_all / db_execute so a slow query or a busy writer never blocks the event loop.
+DB_PATH = os.environ.get("API_KEYS_DB_PATH", "api_keys.db")
+DB_POOL_SIZE = 8
+DB_STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per connection
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL", # Readers don't block the writer and vice versa
+    "PRAGMA synchronous=NORMAL", # Safe with WAL; fsync on checkpoint instead of every commit
+    "PRAGMA cache_size=-16000", # ~16 MB page cache per connection
+    "PRAGMA mmap_size=268435456", # Memory-map up to 256 MB of the database file
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000", # Wait for the write lock instead of failing with "database is locked"
+)
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections that can be used from any executor thread."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue() # LIFO keeps the hottest connections (and their caches) in use
+        self._created = 0
+        self._lock = threading.Lock() # Guards _created and _stats, which every executor thread updates
+        self._stats = {"acquired": 0, "waits": 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        with self._lock:
+            self._stats["waits"] += 1
+        return self._idle.get()
+
+    def _release(self, conn):
+        if conn.in_transaction: # Never hand out a connection with a half-finished transaction
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        with self._lock:
+            self._stats["acquired"] += 1
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {**self._stats, "open_connections": self._created}
+        return {**counters, "idle_connections": self._idle.qsize(), "size": self.size}
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+# One worker per pooled connection, so a query never queues twice (for a thread, then for a connection)
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="sqlite")
+
+async def run_db(func, *args):
+    """Runs func(conn, *args) with a pooled connection on the DB executor and returns its result."""
+    def call():
+        with db_pool.connection() as conn:
+            started = time.perf_counter()
+            try:
+                return func(conn, *args)
+            finally:
+                db_query_duration_seconds.observe(time.perf_counter() - started)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, call)
+
+async def db_fetch_one(sql: str, params: tuple = ()):
+    return await run_db(lambda conn: conn.execute(sql, params).fetchone())
+
+async def db_fetch_all(sql: str, params: tuple = ()):
+    return await run_db(lambda conn: conn.execute(sql, params).fetchall())
+
+async def db_execute(sql: str, params: tuple = ()):
+    """Executes a single write statement in its own transaction and returns the cursor (lastrowid, rowcount)."""
+    def execute(conn):
+        with conn:
+            return conn.execute(sql, params)
+    return await run_db(execute)
 
 @app.on_event("startup")
 def init_db():
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS api_keys (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT UNIQUE NOT NULL,
-                is_active BOOLEAN DEFAULT 1,
-                created_at REAL,
-                last_used REAL,
-                usage_count INTEGER DEFAULT 0,
-                user_id INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users (id)
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_keys (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT UNIQUE NOT NULL,
+                    is_active BOOLEAN DEFAULT 1,
+                    created_at REAL,
+                    last_used REAL,
+                    usage_count INTEGER DEFAULT 0,
+                    user_id INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            # Create users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    hashed_password TEXT NOT NULL,
+                    plan TEXT NOT NULL DEFAULT 'free'
+                )
+            ''')
+            # Databases created before plans existed get the column added in place
+            user_columns = {row["name"] for row in cursor.execute("PRAGMA table_info(users)")}
+            if "plan" not in user_columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN plan TEXT NOT NULL DEFAULT 'free'")
+            # Speeds up the per-user key listing and stats queries
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_user_id ON api_keys (user_id)")
+            # Append-only price history: one row per observed price change
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS price_ticks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    symbol TEXT NOT NULL,
+                    price REAL NOT NULL,
+                    timestamp REAL NOT NULL,
+                    source TEXT NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_ticks_symbol_time ON price_ticks (symbol, timestamp)")
+            # OHLC rollups maintained incrementally as ticks arrive, one row per symbol/resolution/bucket
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS price_bars (
+                    symbol TEXT NOT NULL,
+                    resolution TEXT NOT NULL,
+                    bucket_start REAL NOT NULL,
+                    open REAL NOT NULL,
+                    high REAL NOT NULL,
+                    low REAL NOT NULL,
+                    close REAL NOT NULL,
+                    tick_count INTEGER NOT NULL DEFAULT 1,
+                    PRIMARY KEY (symbol, resolution, bucket_start)
+                ) WITHOUT ROWID
+            ''')
+            # Bumped in the same transaction as any write to a symbol's bars, by whichever process makes it
+            # (the fetching worker, or history_cli.py), so every worker can tell when derived results are out of date
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS price_history_versions (
+                    symbol TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                ) WITHOUT ROWID
+            ''')
+            # Which symbols each key's price requests asked for, maintained by the batched usage flush
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_key_symbol_usage (
+                    key TEXT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    usage_count INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL,
+                    PRIMARY KEY (key, symbol)
+                ) WITHOUT ROWID
+            ''')
+            # Resume points of bulk history backfills (history_cli.py), one row per input stream
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS history_backfill_progress (
+                    job TEXT PRIMARY KEY,
+                    last_timestamp REAL NOT NULL,
+                    rows_loaded INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            # Usage counters per key and per user, one row per UTC day ('2026-10-16') and month ('2026-10'),
+            # incremented by the batched usage flush
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_key_usage_rollups (
+                    key TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    usage_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (key, period, bucket)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_usage_rollups (
+                    user_id INTEGER NOT NULL,
+                    period TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    usage_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, period, bucket)
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+    except Exception as e:
+        logger.exception("Error during DB initialization")
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call (e.g. yf.download) in the default thread pool so the event loop keeps serving."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+# --- In-process Caches ---
+
+class LRUTTLCache:
+    """Size-bounded LRU cache whose entries also expire after a TTL. Tracks hit/miss/eviction counts."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return value
+
+    def put(self, key, value, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else None
+        }
+
+# Active API keys, keyed by the key value. Revoking, deleting or creating a key updates this immediately.
+# Workers sharing SHARED_PRICE_CACHE_PATH also share an auth generation in that file: a worker that changes a
+# key or user bumps it, and every worker checks it on each lookup and drops its key and principal caches when
+# it moved, so a revoked key stops working on all of them at once. The TTL only bounds how long a change made
+# by any other process (e.g. a direct database edit) can go unnoticed.
+API_KEY_CACHE_MAX_ENTRIES = 10000
+API_KEY_CACHE_TTL_SECONDS = 300
+api_key_cache = LRUTTLCache(API_KEY_CACHE_MAX_ENTRIES, API_KEY_CACHE_TTL_SECONDS)
+# Keys that failed validation (unknown, revoked or garbage), so repeating one is rejected without a database
+# lookup. Kept apart from api_key_cache so a flood of made-up keys can't evict the valid ones; cleared and
+# invalidated along with it.
+REJECTED_API_KEY_CACHE_MAX_ENTRIES = 10000
+REJECTED_API_KEY_CACHE_TTL_SECONDS = 60
+rejected_api_key_cache = LRUTTLCache(REJECTED_API_KEY_CACHE_MAX_ENTRIES, REJECTED_API_KEY_CACHE_TTL_SECONDS)
+auth_cache_generation = {"seen": 0} # Last shared auth generation this worker's caches were checked against
+
+def sync_auth_caches() -> int:
+    """Clears the key and principal caches if another worker published an auth change; returns the generation."""
+    generation = shared_price_cache.auth_generation() if shared_price_cache is not None else None
+    if generation is not None and generation != auth_cache_generation["seen"]:
+        auth_cache_generation["seen"] = generation
+        api_key_cache.clear()
+        rejected_api_key_cache.clear()
+        principal_cache.clear()
+    return auth_cache_generation["seen"]
+
+def publish_auth_change():
+    """Makes the other workers drop their cached keys and principals; call after the change is committed."""
+    if shared_price_cache is not None:
+        shared_price_cache.bump_auth_generation()
+
+async def lookup_active_api_key(api_key: str) -> Optional[dict]:
+    """Returns {"id", "user_id", "plan"} for an active key, or None. Only cache misses touch the database."""
+    generation = sync_auth_caches()
+    key_record = api_key_cache.get(api_key)
+    if key_record is not None:
+        return key_record
+    if rejected_api_key_cache.get(api_key) is not None:
+        return None
+    row = await db_fetch_one(
+        '''
+        SELECT api_keys.id, api_keys.user_id, COALESCE(users.plan, 'free') AS plan
+        FROM api_keys LEFT JOIN users ON users.id = api_keys.user_id
+        WHERE api_keys.key = ? AND api_keys.is_active = 1
+        ''',
+        (api_key,)
+    )
+    if row is None:
+        if sync_auth_caches() == generation:
+            rejected_api_key_cache.put(api_key, True)
+        return None
+    key_record = dict(row)
+    if sync_auth_caches() == generation: # A change published while we read may already be in this row's past
+        api_key_cache.put(api_key, key_record)
+    return key_record
+
+
+# --- Write-behind Usage Accounting ---
+# Price requests only bump in-memory counters; a background task writes them to SQLite as one batched
+# transaction every USAGE_FLUSH_INTERVAL_SECONDS, or sooner once USAGE_FLUSH_MAX_PENDING_EVENTS pile up.
+# Readers add the not-yet-flushed deltas to the persisted values, so reported counts stay current.
+# Price requests also count which symbols they asked for; a multi-symbol request is one usage event
+# with one breakdown entry per symbol. Each event is also counted under its UTC day, and the flush adds
+# those counts to the per-key and per-user day/month rollups, so per-period usage is a primary-key lookup.
+USAGE_FLUSH_INTERVAL_SECONDS = 0.5
+USAGE_FLUSH_MAX_PENDING_EVENTS = 1000
+USAGE_PERIODS = ("day", "month")
+
+def usage_bucket(period: str, day: int) -> str:
+    """Rollup bucket label for a UTC day number (days since the epoch): '2026-10-16' or '2026-10'."""
+    return time.strftime("%Y-%m-%d" if period == "day" else "%Y-%m", time.gmtime(day * 86400))
+
+def recent_usage_buckets(period: str, count: int, now: Optional[float] = None) -> List[str]:
+    """The last count day or month buckets up to and including the current one, oldest first."""
+    today = int((time.time() if now is None else now) // 86400)
+    if period == "day":
+        return [usage_bucket("day", day) for day in range(today - count + 1, today + 1)]
+    year, month = map(int, usage_bucket("month", today).split("-"))
+    months = year * 12 + month - 1
+    return [f"{index // 12:04d}-{index % 12 + 1:02d}" for index in range(months - count + 1, months + 1)]
+
+class UsageAccumulator:
+    """Accumulates per-key usage increments and last-used timestamps in memory and flushes them in batches."""
+
+    def __init__(self, flush_interval_seconds: float, max_pending_events: int):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_events = max_pending_events
+        # key -> [usage increment, last_used, {symbol: increment}, {UTC day number: increment}, owner's user id or None]
+        self._pending = {}
+        self._flushing = {} # batch currently being written, still counted by readers
+        self._pending_events = 0
+        self._flush_lock = asyncio.Lock() # One batch in flight at a time
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._stats = {"events": 0, "flushes": 0, "rows_written": 0, "flush_errors": 0}
+
+    def record(self, key: str, symbols: Iterable[str] = (), user_id: Optional[int] = None):
+        """Counts one use of key. Pass the owner's user_id when known (e.g. from the validated key record):
+        the flush credits the user's rollups with it directly, even if the key is deleted before then."""
+        now = time.time()
+        day = int(now // 86400)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [1, now, {}, {day: 1}, user_id]
+        else:
+            entry[0] += 1
+            entry[1] = now
+            entry[3][day] = entry[3].get(day, 0) + 1
+            if user_id is not None:
+                entry[4] = user_id
+        symbol_counts = entry[2]
+        for symbol in symbols:
+            symbol_counts[symbol] = symbol_counts.get(symbol, 0) + 1
+        self._pending_events += 1
+        self._stats["events"] += 1
+        if self._pending_events >= self.max_pending_events and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending_for(self, key: str):
+        """Returns (unflushed usage increment, latest last_used or None) for key."""
+        count = 0
+        last_used = None
+        for source in (self._flushing, self._pending):
+            entry = source.get(key)
+            if entry is not None:
+                count += entry[0]
+                last_used = entry[1] if last_used is None else max(last_used, entry[1])
+        return count, last_used
+
+    def pending_symbols_for(self, key: str) -> dict:
+        """Returns the unflushed per-symbol usage increments for key."""
+        symbol_counts = {}
+        for source in (self._flushing, self._pending):
+            entry = source.get(key)
+            if entry is not None:
+                for symbol, count in entry[2].items():
+                    symbol_counts[symbol] = symbol_counts.get(symbol, 0) + count
+        return symbol_counts
+
+    def pending_periods_for(self, key: str, period: str) -> dict:
+        """Returns the unflushed usage increments for key by day or month bucket."""
+        bucket_counts = {}
+        for source in (self._flushing, self._pending):
+            entry = source.get(key)
+            if entry is not None:
+                for day, count in entry[3].items():
+                    bucket = usage_bucket(period, day)
+                    bucket_counts[bucket] = bucket_counts.get(bucket, 0) + count
+        return bucket_counts
+
+    def _write_batch(self, conn, batch: dict):
+        rollup_rows = []
+        for key, entry in batch.items():
+            bucket_counts = {}
+            for day, count in entry[3].items():
+                for period in USAGE_PERIODS:
+                    bucket = (period, usage_bucket(period, day))
+                    bucket_counts[bucket] = bucket_counts.get(bucket, 0) + count
+            rollup_rows.extend((key, entry[4], period, bucket, count) for (period, bucket), count in bucket_counts.items())
+        with conn: # One transaction (and one fsync) for the whole batch
+            conn.executemany(
+                "UPDATE api_keys SET usage_count = usage_count + ?, last_used = MAX(COALESCE(last_used, 0), ?) WHERE key = ?",
+                [(count, last_used, key) for key, (count, last_used, _, _, _) in batch.items()]
             )
-        ''')
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                hashed_password TEXT NOT NULL
+            # Usage of keys that no longer exist (or never did) has no owner to roll up to
+            conn.executemany(
+                '''
+                INSERT INTO api_key_usage_rollups (key, period, bucket, usage_count)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM api_keys WHERE key = ?)
+                ON CONFLICT (key, period, bucket) DO UPDATE SET usage_count = usage_count + excluded.usage_count
+                ''',
+                [(key, period, bucket, count, key) for key, _, period, bucket, count in rollup_rows]
             )
-        ''')
-        conn.commit()
-    except Exception as e:
-        print("!!! ERROR DURING DB INITIALIZATION !!!")
-        traceback.print_exc()
-    finally:
-        if conn:
-            conn.close()
+            # The owner recorded with the usage wins, so a key deleted since still credits its user; usage
+            # recorded without one (e.g. /api-keys/{key}/log) goes to the key's current owner, if it has one
+            conn.executemany(
+                '''
+                INSERT INTO user_usage_rollups (user_id, period, bucket, usage_count)
+                SELECT owner, ?, ?, ? FROM (SELECT COALESCE(?, (SELECT user_id FROM api_keys WHERE key = ?)) AS owner)
+                WHERE owner IS NOT NULL
+                ON CONFLICT (user_id, period, bucket) DO UPDATE SET usage_count = usage_count + excluded.usage_count
+                ''',
+                [(period, bucket, count, user_id, key) for key, user_id, period, bucket, count in rollup_rows]
+            )
+            conn.executemany(
+                '''
+                INSERT INTO api_key_symbol_usage (key, symbol, usage_count, last_used)
+                SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM api_keys WHERE key = ?)
+                ON CONFLICT (key, symbol) DO UPDATE SET
+                    usage_count = usage_count + excluded.usage_count,
+                    last_used = MAX(COALESCE(last_used, 0), excluded.last_used)
+                ''',
+                [
+                    (key, symbol, symbol_count, last_used, key)
+                    for key, (_, last_used, symbol_counts, _, _) in batch.items()
+                    for symbol, symbol_count in symbol_counts.items()
+                ]
+            )
+
+    async def flush(self):
+        """Writes everything recorded so far. Waits for a batch another caller is still writing, so on return
+        all usage recorded before the call is in the database."""
+        if not self._pending and not self._flush_lock.locked():
+            return # Nothing to write and no batch in flight; don't queue behind other callers for the lock
+        async with self._flush_lock:
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_events = self._pending, {}, 0
+        self._flushing = batch
+        try:
+            await run_db(self._write_batch, batch)
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(batch)
+        except Exception as e:
+            # Put the deltas back so they are retried on the next flush instead of being lost
+            self._stats["flush_errors"] += 1
+            for key, (count, last_used, symbol_counts, day_counts, user_id) in batch.items():
+                entry = self._pending.setdefault(key, [0, last_used, {}, {}, user_id])
+                entry[0] += count
+                entry[1] = max(entry[1], last_used)
+                if entry[4] is None:
+                    entry[4] = user_id
+                for symbol, symbol_count in symbol_counts.items():
+                    entry[2][symbol] = entry[2].get(symbol, 0) + symbol_count
+                for day, day_count in day_counts.items():
+                    entry[3][day] = entry[3].get(day, 0) + day_count
+                self._pending_events += count
+            logger.error("Error flushing API key usage, will retry: %s", e, extra={"fields": {"keys": len(batch)}})
+        finally:
+            self._flushing = {}
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Asks the loop to finish rather than cancelling it: a cancel that lands while wait_for is returning
+        # can be swallowed (Python < 3.12), leaving shutdown waiting on the task forever
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {**self._stats, "pending_keys": len(self._pending), "pending_events": self._pending_events}
+
+usage_accumulator = UsageAccumulator(USAGE_FLUSH_INTERVAL_SECONDS, USAGE_FLUSH_MAX_PENDING_EVENTS)
+
+@app.on_event("startup")
+async def start_usage_accumulator():
+    usage_accumulator.start()
+
+@app.on_event("shutdown")
+async def flush_usage_on_shutdown():
+    await usage_accumulator.stop()
+
+
+# --- Per-key Rate Limiting ---
+# Token buckets keyed by API key: each plan's bucket holds `limit` tokens and refills continuously over
+# `period_seconds` (e.g. 100 requests/day for free users). Buckets live in lock-sharded dicts, so a check
+# is an O(1) dict lookup plus a little arithmetic. Keys that already have a bucket are throttled before
+# any database lookup; a key's bucket is created the first time it validates successfully, and dropped when
+# the key is deactivated or deleted. Keys that fail validation never get a bucket; rejected_api_key_cache
+# turns repeats of them away without a lookup instead.
+PLAN_RATE_LIMITS = {
+    "free": {"limit": 100, "period_seconds": 86400},
+    "premium": {"limit": 100000, "period_seconds": 86400},
+}
+RATE_LIMIT_SHARDS = 16
+
+class RateLimiter:
+    """Sharded in-memory token-bucket limiter."""
+
+    def __init__(self, plan_limits: dict, shards: int):
+        self.plan_limits = plan_limits
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._stats = {"allowed": 0, "throttled": 0}
+
+    def acquire(self, key: str, plan: Optional[str] = None) -> Optional[dict]:
+        """Takes one token from key's bucket and returns the decision. Returns None if key has no bucket yet
+        and no plan was given to create one."""
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if plan is None:
+                    return None
+                limits = self.plan_limits.get(plan, self.plan_limits["free"])
+                # [tokens, last refill time, capacity, refill rate per second]
+                bucket = [float(limits["limit"]), now, float(limits["limit"]), limits["limit"] / limits["period_seconds"]]
+                buckets[key] = bucket
+            tokens, last_refill, capacity, rate = bucket
+            tokens = min(capacity, tokens + (now - last_refill) * rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            bucket[0] = tokens
+            bucket[1] = now
+        self._stats["allowed" if allowed else "throttled"] += 1
+        return {
+            "allowed": allowed,
+            "limit": int(capacity),
+            "remaining": int(tokens),
+            "reset_seconds": math.ceil((capacity - tokens) / rate), # Until the bucket is full again
+            "retry_after_seconds": 0 if allowed else math.ceil((1.0 - tokens) / rate)
+        }
+
+    def forget(self, key: str):
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            buckets.pop(key, None)
+
+    def stats(self) -> dict:
+        return {**self._stats, "buckets": sum(len(buckets) for buckets, _ in self._shards)}
+
+rate_limiter = RateLimiter(PLAN_RATE_LIMITS, RATE_LIMIT_SHARDS)
+
+def rate_limit_headers(decision: dict) -> dict:
+    headers = {
+        "X-RateLimit-Limit": str(decision["limit"]),
+        "X-RateLimit-Remaining": str(decision["remaining"]),
+        "X-RateLimit-Reset": str(decision["reset_seconds"])
+    }
+    if not decision["allowed"]:
+        headers["Retry-After"] = str(decision["retry_after_seconds"])
+    return headers
+
+def enforce_rate_limit(decision: dict):
+    if not decision["allowed"]:
+        auth_failures_total.inc(("rate_limited",))
+        logger.info("Rate limit exceeded", extra={"sample_every": 100, "fields": {"limit": decision["limit"]}})
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded for this API key",
+            headers=rate_limit_headers(decision)
+        )
+
 
 # --- Authentication Utilities ---
 
@@ -127,6 +1099,78 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+# bcrypt is deliberately slow (~100-300 ms of CPU per call). It runs on a small dedicated thread pool
+# (bcrypt releases the GIL) so logins never stall the event loop, and at most PASSWORD_HASH_MAX_PENDING
+# calls may be queued or running; beyond that, new logins/registrations are shed with a 503 + Retry-After
+# instead of piling up behind a storm.
+PASSWORD_HASH_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = 64
+
+class PasswordHasher:
+    """Bounded worker pool for password hashing/verification with queue-depth metrics."""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._pending = 0 # Queued + running
+        self._stats = {"completed": 0, "failed": 0, "rejected": 0, "peak_pending": 0, "total_wait_seconds": 0.0, "total_run_seconds": 0.0}
+
+    async def _run(self, func, *args):
+        if self._pending >= self.max_pending:
+            self._stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many concurrent authentication requests, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        self._stats["peak_pending"] = max(self._stats["peak_pending"], self._pending)
+        submitted_at = time.perf_counter()
+
+        def call():
+            started_at = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                timings.extend((started_at - submitted_at, time.perf_counter() - started_at))
+
+        timings = []
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, call)
+        except BaseException:
+            self._stats["failed"] += 1
+            raise
+        else:
+            self._stats["completed"] += 1
+            return result
+        finally:
+            self._pending -= 1
+            if timings:
+                self._stats["total_wait_seconds"] += timings[0]
+                self._stats["total_run_seconds"] += timings[1]
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        ran = self._stats["completed"] + self._stats["failed"] # Calls that reached a worker, whatever the outcome
+        return {
+            **self._stats,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "queue_depth": max(0, self._pending - self.workers),
+            "avg_wait_ms": round(1000 * self._stats["total_wait_seconds"] / ran, 2) if ran else None,
+            "avg_run_ms": round(1000 * self._stats["total_run_seconds"] / ran, 2) if ran else None
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -137,13 +1181,32 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Verified token -> user record. A repeat call with the same token skips both the signature check and the
+# users query. Entries never outlive the token's own exp, and invalidate_user_principals drops a user's
+# entries (via a per-user generation counter) as soon as their record changes.
+PRINCIPAL_CACHE_MAX_ENTRIES = 10000
+PRINCIPAL_CACHE_TTL_SECONDS = 60
+principal_cache = LRUTTLCache(PRINCIPAL_CACHE_MAX_ENTRIES, PRINCIPAL_CACHE_TTL_SECONDS)
+principal_generations = {} # username -> generation, bumped on every change to that user
+
+def invalidate_user_principals(username: str):
+    """Drops cached principals for an existing user whose record changed, on every worker."""
+    principal_generations[username] = principal_generations.get(username, 0) + 1
+    publish_auth_change()
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    conn = None
+    shared_generation = sync_auth_caches()
+    cached = principal_cache.get(token)
+    if cached is not None:
+        user, generation = cached
+        if principal_generations.get(user["username"], 0) == generation:
+            return dict(user)
+        principal_cache.invalidate(token)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -151,64 +1214,59 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             raise credentials_exception
         token_data = TokenData(username=username)
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = ?", (token_data.username,))
-        user = cursor.fetchone()
+        generation = principal_generations.get(token_data.username, 0)
+        user = await db_fetch_one("SELECT * FROM users WHERE username = ?", (token_data.username,))
 
         if user is None:
             raise credentials_exception
+        user = dict(user)
+        expires_in = payload["exp"] - time.time() if "exp" in payload else PRINCIPAL_CACHE_TTL_SECONDS
+        if expires_in > 0 and sync_auth_caches() == shared_generation:
+            principal_cache.put(token, (user, generation), ttl_seconds=expires_in)
         # Return the user object (as a dictionary)
         return dict(user)
     except JWTError:
+        auth_failures_total.inc(("invalid_token",))
         raise credentials_exception
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
+        if http_exc is credentials_exception:
+            auth_failures_total.inc(("invalid_token",))
+        raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in get_current_user !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in get_current_user")
         # Re-raise as a 500 error if it wasn't a standard auth error
         raise HTTPException(status_code=500, detail="Internal server error during authentication.")
-    finally:
-        if conn:
-            conn.close()
 
 
 # --- User Management ---
 
 @app.post("/register", status_code=status.HTTP_201_CREATED)
 async def register_user(user_data: UserCreate):
-    conn = None # Initialize conn to None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        hashed_pw = get_password_hash(user_data.password) # Use passlib hashing
-        cursor.execute(
+        hashed_pw = await password_hasher.hash(user_data.password) # passlib hashing, off the event loop
+        cursor = await db_execute(
             "INSERT INTO users (username, hashed_password) VALUES (?, ?)",
             (user_data.username, hashed_pw)
         )
-        conn.commit()
         user_id = cursor.lastrowid
+        # Nothing to invalidate: users are never deleted or renamed, so no token can already map to this account
         return {"id": user_id, "username": user_data.username, "message": "User registered successfully"}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Username already exists")
+    except HTTPException as http_exc: # Re-raise HTTP exceptions (e.g. hashing pool saturated)
+        raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in register_user !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in register_user")
         raise HTTPException(status_code=500, detail="An unexpected error occurred during registration.")
-    finally:
-        if conn:
-            conn.close()
 
 # Login endpoint using OAuth2PasswordRequestForm for standard form data
 @app.post("/login", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    conn = None # Initialize conn to None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = ?", (form_data.username,))
-        user = cursor.fetchone()
+        user = await db_fetch_one("SELECT * FROM users WHERE username = ?", (form_data.username,))
 
-        if not user or not verify_password(form_data.password, user["hashed_password"]):
+        if not user or not await password_hasher.verify(form_data.password, user["hashed_password"]):
+            auth_failures_total.inc(("bad_credentials",))
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
@@ -223,12 +1281,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     except HTTPException as http_exc: # Re-raise HTTP exceptions
         raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in login_for_access_token !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in login_for_access_token")
         raise HTTPException(status_code=500, detail="An unexpected error occurred during login.")
-    finally:
-        if conn:
-            conn.close()
 
 
 # Example protected endpoint to get current user info
@@ -243,25 +1297,20 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
 @app.get("/api-keys", response_model=List[APIKey])
 async def get_user_keys(current_user: dict = Depends(get_current_user)):
     """Gets API keys belonging to the currently authenticated user."""
-    conn = None # Initialize conn to None
     keys = [] # Initialize keys list outside try block
     try: # Wrap the entire function logic
         user_id = current_user["id"]
-        conn = get_db_connection()
-        cursor = conn.cursor()
         # Select only the columns needed for the APIKey model
-        cursor.execute(
+        fetched_rows = await db_fetch_all(
             "SELECT key, is_active, created_at, last_used, usage_count, user_id FROM api_keys WHERE user_id = ?",
             (user_id,)
         )
-        fetched_rows = cursor.fetchall()
 
-        print(f"--- Processing {len(fetched_rows)} rows for user {user_id} ---") # Log row count
+        logger.debug("Processing API key rows", extra={"fields": {"user_id": user_id, "rows": len(fetched_rows)}})
         for row_num, row in enumerate(fetched_rows):
             # Inner try-except for processing each row
             try:
                 row_dict = dict(row) # Convert row to dict for easier checking
-                print(f"Processing row {row_num}: {row_dict}") # Log each row
 
                 # More robust mapping with checks for None where not allowed by Pydantic model
                 key_data = {
@@ -273,150 +1322,199 @@ async def get_user_keys(current_user: dict = Depends(get_current_user)):
                     "user_id": row_dict.get("user_id") # Optional in model, can be None
                 }
 
+                # Add usage that is still waiting to be flushed to the database
+                pending_count, pending_last_used = usage_accumulator.pending_for(key_data["key"])
+                if pending_count and key_data["usage_count"] is not None:
+                    key_data["usage_count"] += pending_count
+                if pending_last_used is not None:
+                    key_data["last_used"] = max(key_data["last_used"] or 0, pending_last_used)
+
                 # Check for None in required fields before creating model
                 required_fields = ["key", "created_at", "last_used", "usage_count"]
                 for field in required_fields:
                      if key_data[field] is None:
-                         print(f"Error: Field '{field}' is None in row {row_num} for user {user_id}. Row data: {row_dict}")
+                         logger.error("Field %r is None in API key row", field, extra={"fields": {"user_id": user_id, "row": row_num}})
                          raise ValueError(f"Field '{field}' cannot be None.")
 
                 # Attempt to create the Pydantic model
                 keys.append(APIKey(**key_data))
 
             except (Exception, ValueError) as e: # Catch ValueError and other exceptions during row processing
-                print(f"Error processing row #{row_num} for user {user_id}: {row_dict}")
-                print(f"Instantiation/Validation error: {e}")
+                logger.error("Error processing API key row: %s", e, extra={"fields": {"user_id": user_id, "row": row_num}})
                 # Raise 500 error to signal backend issue for this specific row
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail=f"Error processing API key data (row {row_num}). Check server logs."
                 )
 
-        print(f"--- Successfully processed {len(keys)} keys for user {user_id} ---") # Log success
         return keys
 
     except Exception as e: # Catch ANY unexpected exception in the outer block
-        print(f"!!! UNEXPECTED ERROR in get_user_keys for user {current_user.get('id', 'UNKNOWN')} !!!")
-        traceback.print_exc() # Print detailed traceback to server console
+        logger.exception("Unexpected error in get_user_keys", extra={"fields": {"user_id": current_user.get("id")}})
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An unexpected error occurred while fetching API keys. Check server logs."
         )
-    finally:
-        if conn:
-            conn.close() # Ensure connection is closed
 
 @app.post("/api-keys/{key}/toggle")
 async def toggle_key_status(key: str, current_user: dict = Depends(get_current_user)):
     """Toggles the status of an API key belonging to the current user."""
-    conn = None # Initialize conn to None
     try:
         user_id = current_user["id"]
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # Ensure the key belongs to the user before toggling
-        cursor.execute("SELECT id FROM api_keys WHERE key = ? AND user_id = ?", (key, user_id))
-        key_record = cursor.fetchone()
-
-        if not key_record:
+        # Scoping the update by user_id ensures the key belongs to the user
+        cursor = await db_execute("UPDATE api_keys SET is_active = NOT is_active WHERE key = ? AND user_id = ?", (key, user_id))
+        if cursor.rowcount == 0:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API key not found or not owned by user")
 
-        cursor.execute("UPDATE api_keys SET is_active = NOT is_active WHERE key = ? AND user_id = ?", (key, user_id))
-        conn.commit()
+        # Drop the cached validation so a deactivated key stops working right away (and a reactivated one
+        # works again), on every worker. A deactivated key's rate limit bucket goes with it.
+        api_key_cache.invalidate(key)
+        rejected_api_key_cache.invalidate(key)
+        rate_limiter.forget(key)
+        publish_auth_change()
         return {"message": f"Key {key} status toggled"}
     except HTTPException as http_exc: # Re-raise HTTP exceptions
         raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in toggle_key_status for key {key}, user {current_user.get('id', 'UNKNOWN')} !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in toggle_key_status", extra={"fields": {"key": key[:8], "user_id": current_user.get("id")}})
         raise HTTPException(status_code=500, detail="An unexpected error occurred while toggling key status.")
-    finally:
-        if conn:
-            conn.close()
 
 
 @app.get("/api-keys/stats")
 async def get_user_key_stats(current_user: dict = Depends(get_current_user)):
     """Gets statistics (total keys, total usage) for the authenticated user."""
-    conn = None # Initialize conn to None
     try:
         user_id = current_user["id"]
-        conn = get_db_connection()
-        cursor = conn.cursor()
         # Calculate stats only for the current user's keys
-        cursor.execute(
-            "SELECT COUNT(*) as total, SUM(usage_count) as usage FROM api_keys WHERE user_id = ?",
+        rows = await db_fetch_all("SELECT key, usage_count FROM api_keys WHERE user_id = ?", (user_id,))
+
+        # Persisted counts plus usage still waiting to be flushed (zero if the user has no keys yet)
+        total_keys = len(rows)
+        total_usage = sum((row["usage_count"] or 0) + usage_accumulator.pending_for(row["key"])[0] for row in rows)
+
+        # Price requests per symbol across the user's keys
+        symbol_rows = await db_fetch_all(
+            '''
+            SELECT api_key_symbol_usage.symbol, SUM(api_key_symbol_usage.usage_count) AS usage_count
+            FROM api_key_symbol_usage JOIN api_keys ON api_keys.key = api_key_symbol_usage.key
+            WHERE api_keys.user_id = ?
+            GROUP BY api_key_symbol_usage.symbol
+            ''',
             (user_id,)
         )
-        stats = cursor.fetchone()
-
-        # Ensure stats are returned even if the user has no keys yet
-        total_keys = stats["total"] if stats and stats["total"] is not None else 0
-        total_usage = stats["usage"] if stats and stats["usage"] is not None else 0
+        usage_by_symbol = {row["symbol"]: row["usage_count"] for row in symbol_rows}
+        keys = [row["key"] for row in rows]
+        for row in rows:
+            for symbol, count in usage_accumulator.pending_symbols_for(row["key"]).items():
+                usage_by_symbol[symbol] = usage_by_symbol.get(symbol, 0) + count
 
         return {
             "user_id": user_id,
             "username": current_user["username"],
             "total_keys": total_keys,
-            "total_usage": total_usage
+            "total_usage": total_usage,
+            "usage_today": (await usage_by_period("user_id", user_id, keys, "day", 1))[0]["usage_count"],
+            "usage_this_month": (await usage_by_period("user_id", user_id, keys, "month", 1))[0]["usage_count"],
+            "usage_by_symbol": usage_by_symbol
         }
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in get_user_key_stats for user {current_user.get('id', 'UNKNOWN')} !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in get_user_key_stats", extra={"fields": {"user_id": current_user.get("id")}})
         raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching key statistics.")
-    finally:
-        if conn:
-            conn.close()
+
+
+USAGE_MAX_BUCKETS = 366
+
+async def usage_by_period(owner_column: str, owner, keys: List[str], period: str, limit: int) -> List[dict]:
+    """Usage of one key (owner_column "key") or one user ("user_id") in each of the last limit day/month
+    buckets, oldest first, read from the rollups plus the unflushed counts of keys."""
+    buckets = recent_usage_buckets(period, limit)
+    table = "api_key_usage_rollups" if owner_column == "key" else "user_usage_rollups"
+    rows = await db_fetch_all(
+        f"SELECT bucket, usage_count FROM {table} WHERE {owner_column} = ? AND period = ? AND bucket >= ?",
+        (owner, period, buckets[0])
+    )
+    counts = {row["bucket"]: row["usage_count"] for row in rows}
+    for key in keys:
+        for bucket, count in usage_accumulator.pending_periods_for(key, period).items():
+            counts[bucket] = counts.get(bucket, 0) + count
+    return [{"bucket": bucket, "usage_count": counts.get(bucket, 0)} for bucket in buckets]
+
+def validate_usage_query(period: str, limit: int):
+    if period not in USAGE_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Unsupported period '{period}'. Use one of: {', '.join(USAGE_PERIODS)}")
+    if not 1 <= limit <= USAGE_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {USAGE_MAX_BUCKETS}")
+
+
+@app.get("/api-keys/{key}/usage")
+async def get_key_usage(key: str, period: str = "day", limit: int = 30, current_user: dict = Depends(get_current_user)):
+    """Usage of one of the user's keys per UTC day or month, for the last limit periods."""
+    try:
+        validate_usage_query(period, limit)
+        owned = await db_fetch_one("SELECT 1 FROM api_keys WHERE key = ? AND user_id = ?", (key, current_user["id"]))
+        if owned is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API key not found or not owned by user")
+        return {"key": key, "period": period, "usage": await usage_by_period("key", key, [key], period, limit)}
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
+        raise http_exc
+    except Exception as e:
+        logger.exception("Unexpected error in get_key_usage", extra={"fields": {"key": key[:8], "user_id": current_user.get("id")}})
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching key usage.")
+
+
+@app.get("/usage")
+async def get_user_usage(period: str = "day", limit: int = 30, current_user: dict = Depends(get_current_user)):
+    """Usage across all of the user's keys (including deleted ones) per UTC day or month, for the last limit periods."""
+    try:
+        validate_usage_query(period, limit)
+        user_id = current_user["id"]
+        rows = await db_fetch_all("SELECT key FROM api_keys WHERE user_id = ?", (user_id,))
+        usage = await usage_by_period("user_id", user_id, [row["key"] for row in rows], period, limit)
+        return {"user_id": user_id, "period": period, "usage": usage, "total": sum(entry["usage_count"] for entry in usage)}
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
+        raise http_exc
+    except Exception as e:
+        logger.exception("Unexpected error in get_user_usage", extra={"fields": {"user_id": current_user.get("id")}})
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching usage.")
 
 
 @app.post("/api-keys/{key}/log")
 async def log_key_usage(key: str):
-    conn = None # Initialize conn to None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE api_keys SET last_used = ?, usage_count = usage_count + 1 WHERE key = ?",
-            (time.time(), key)
-        )
-        conn.commit()
-        # TODO: Associate usage with the user owning the key - More complex, maybe add a separate logs table?
+        # Counted in memory and persisted (with the owner's day/month rollups) by the next batched flush
+        usage_accumulator.record(key)
         return {"message": "Usage logged"}
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in log_key_usage for key {key} !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in log_key_usage", extra={"fields": {"key": key[:8]}})
         raise HTTPException(status_code=500, detail="An unexpected error occurred while logging key usage.")
-    finally:
-        if conn:
-            conn.close()
 
 
 # Key creation doesn't need a request body now, just auth
 @app.post("/api-keys", response_model=APIKey)
 async def create_key(current_user: dict = Depends(get_current_user)):
     """Creates a new API key for the authenticated user."""
-    conn = None # Initialize conn to None
     try: # Wrap the main logic
         user_id = current_user["id"] # Get user_id from authenticated token
         new_key = secrets.token_urlsafe(32) # Generate a secure random key
         is_active = True # Default to active
         created_at = time.time()
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def insert_key(conn):
+            with conn:
+                conn.execute(
+                    "INSERT INTO api_keys (key, is_active, created_at, last_used, usage_count, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+                    (new_key, is_active, created_at, 0, 0, user_id)
+                )
+            # Fetch only the necessary columns for the APIKey model
+            return conn.execute(
+                "SELECT id, key, is_active, created_at, last_used, usage_count, user_id FROM api_keys WHERE key = ?",
+                (new_key,)
+            ).fetchone()
 
-        cursor.execute(
-            "INSERT INTO api_keys (key, is_active, created_at, last_used, usage_count, user_id) VALUES (?, ?, ?, ?, ?, ?)",
-            (new_key, is_active, created_at, 0, 0, user_id)
-        )
-        conn.commit()
-        # Fetch only the necessary columns for the APIKey model
-        cursor.execute(
-             "SELECT key, is_active, created_at, last_used, usage_count, user_id FROM api_keys WHERE key = ?",
-             (new_key,)
-         )
-        created_key_row = cursor.fetchone()
+        created_key_row = await run_db(insert_key)
         if created_key_row:
+              # Warm the validation cache so the key's first API call skips the DB lookup
+              api_key_cache.put(new_key, {"id": created_key_row["id"], "user_id": created_key_row["user_id"], "plan": current_user.get("plan") or "free"})
               # Explicitly create dict from row before passing to Pydantic model
               key_data = {
                   "key": created_key_row["key"],
@@ -435,333 +1533,1726 @@ async def create_key(current_user: dict = Depends(get_current_user)):
         # Should be rare with secrets.token_urlsafe, but handle just in case
         raise HTTPException(status_code=500, detail="Failed to generate unique API key, please try again")
     except Exception as e: # Catch ANY other unexpected exception
-        print(f"!!! UNEXPECTED ERROR in create_key for user {current_user.get('id', 'UNKNOWN')} !!!")
-        traceback.print_exc() # Print detailed traceback to server console
+        logger.exception("Unexpected error in create_key", extra={"fields": {"user_id": current_user.get("id")}})
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An unexpected error occurred while creating the API key. Check server logs."
         )
-    finally:
-        # Ensure connection is closed even if errors occurred
-        if conn:
-             conn.close()
 
 @app.delete("/api-keys/{key}")
 async def delete_key(key: str, current_user: dict = Depends(get_current_user)):
     """Deletes an API key belonging to the current user."""
-    conn = None # Initialize conn to None
     try:
         user_id = current_user["id"]
-        conn = get_db_connection()
-        cursor = conn.cursor()
         # Ensure the key belongs to the user before deleting
-        cursor.execute("DELETE FROM api_keys WHERE key = ? AND user_id = ?", (key, user_id))
-        if cursor.rowcount == 0:
+        def delete(conn):
+            with conn:
+                cursor = conn.execute("DELETE FROM api_keys WHERE key = ? AND user_id = ?", (key, user_id))
+                if cursor.rowcount:
+                    conn.execute("DELETE FROM api_key_symbol_usage WHERE key = ?", (key,))
+                    conn.execute("DELETE FROM api_key_usage_rollups WHERE key = ?", (key,)) # The user's rollups keep its usage
+                return cursor.rowcount
+        # Roll the key's unflushed usage (including a batch already being written) up to the user while the key still
+        # exists. Usage recorded after this check carries its owner from authentication, so the flush credits the
+        # user even once the key is gone.
+        if usage_accumulator.pending_for(key)[0]:
+            await usage_accumulator.flush()
+        deleted = await run_db(delete)
+        if deleted == 0:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="API key not found or not owned by user")
-        conn.commit()
+        api_key_cache.invalidate(key)
+        rate_limiter.forget(key)
+        publish_auth_change()
         return {"message": f"Key {key} deleted"}
     except HTTPException as http_exc: # Re-raise HTTP exceptions
         raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in delete_key for key {key}, user {current_user.get('id', 'UNKNOWN')} !!!")
-        traceback.print_exc()
+        logger.exception("Unexpected error in delete_key", extra={"fields": {"key": key[:8], "user_id": current_user.get("id")}})
         raise HTTPException(status_code=500, detail="An unexpected error occurred while deleting the key.")
-    finally:
-        if conn:
-            conn.close()
 
 
-async def fetch_live_gold_price():
-    """Fetch current gold price using yfinance"""
-    try:
-        gold_data = yf.download('GC=F', period='1d')
-        if not gold_data.empty:
-            current_price_raw = gold_data['Close'].iloc[-1]
-            current_price_float = float(current_price_raw) # Ensure it's a float
-            print(f"Fetched Gold Price: {current_price_float} (Type: {type(current_price_float)})") # Log fetched value and type
-            return current_price_float
-        return None
-    except Exception as e:
-        print(f"Error fetching/processing gold price: {e}")
-        return None
+# --- Price Providers ---
+# Upstream price sources behind one interface. PRICE_PROVIDERS lists them in fallback order; symbols the
+# first provider can't price (error, timeout or no data) are asked of the next one. With PRICE_HEDGING=1
+# a provider that hasn't answered within its own p95 latency gets the next provider started alongside it,
+# and whichever answers first wins. Set PRICE_PROVIDERS=offline to run without network access.
+PRICE_PROVIDERS = os.environ.get("PRICE_PROVIDERS", "yfinance")
+PRICE_PROVIDER_TIMEOUT_SECONDS = float(os.environ.get("PRICE_PROVIDER_TIMEOUT_SECONDS", "10"))
+PRICE_HEDGING = os.environ.get("PRICE_HEDGING", "0") == "1"
+PRICE_HEDGE_MIN_SAMPLES = 20 # Successful fetches needed before a provider's p95 is trusted as a hedge delay
+PRICE_LATENCY_SAMPLES = 200
+
+# Each provider sits behind a circuit breaker. After PRICE_BREAKER_FAILURE_THRESHOLD consecutive failed
+# fetches (error, timeout, or no prices at all for a multi-symbol batch) it opens, and calls to that provider return nothing at once
+# instead of waiting on a source that is down; the chain moves on to the next provider and requests keep
+# getting the last good snapshot, flagged stale once it ages out. After a cooldown one probe fetch is let
+# through (half-open): success closes the breaker, failure reopens it with the cooldown doubled, up to
+# PRICE_BREAKER_MAX_COOLDOWN_SECONDS. Cooldowns are jittered so workers don't probe in lockstep.
+PRICE_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("PRICE_BREAKER_FAILURE_THRESHOLD", "3"))
+PRICE_BREAKER_COOLDOWN_SECONDS = float(os.environ.get("PRICE_BREAKER_COOLDOWN_SECONDS", "30"))
+PRICE_BREAKER_MAX_COOLDOWN_SECONDS = float(os.environ.get("PRICE_BREAKER_MAX_COOLDOWN_SECONDS", "600"))
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker with exponential, jittered cooldowns."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self._failures = 0 # Consecutive failures while closed
+        self._trips = 0 # Consecutive openings without a successful probe, sets the cooldown
+        self._retry_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {"opened": 0, "short_circuited": 0, "probes": 0}
+
+    def allow(self) -> bool:
+        """Whether a fetch may go upstream now. In half-open state only one probe at a time is allowed."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() < self._retry_at:
+                self._stats["short_circuited"] += 1
+                return False
+            self._transition(self.HALF_OPEN)
+        if self._probe_in_flight:
+            self._stats["short_circuited"] += 1
+            return False
+        self._probe_in_flight = True
+        self._stats["probes"] += 1
+        return True
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self._failures = 0
+        self._trips = 0
+        if self.state != self.CLOSED:
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= PRICE_BREAKER_FAILURE_THRESHOLD:
+            self._open()
+
+    def release_probe(self):
+        """A fetch was abandoned (e.g. it lost a hedge) without an outcome; let the next caller probe."""
+        self._probe_in_flight = False
+
+    def retry_in(self) -> float:
+        """Seconds until a fetch will be allowed again; 0 unless open."""
+        return max(0.0, self._retry_at - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def _open(self):
+        self._trips += 1
+        cooldown = min(PRICE_BREAKER_COOLDOWN_SECONDS * 2 ** (self._trips - 1), PRICE_BREAKER_MAX_COOLDOWN_SECONDS)
+        cooldown = random.uniform(cooldown / 2, cooldown) # "Equal jitter": never less than half the backoff
+        self._retry_at = time.monotonic() + cooldown
+        self._stats["opened"] += 1
+        self._transition(self.OPEN, cooldown)
+
+    def _transition(self, state: str, cooldown: Optional[float] = None):
+        previous, self.state = self.state, state
+        fields = {"provider": self.name, "from": previous, "to": state, "consecutive_failures": self._failures}
+        if cooldown is not None:
+            fields["cooldown_seconds"] = round(cooldown, 1)
+        logger.log(logging.WARNING if state == self.OPEN else logging.INFO, "Price provider circuit %s", state, extra={"fields": fields})
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_in_seconds": round(self.retry_in(), 1)
+        }
 
-async def fetch_live_silver_price():
-    """Fetch current silver price using yfinance"""
-    try:
-        silver_data = yf.download('SI=F', period='1d')
-        if not silver_data.empty:
-            current_price_raw = silver_data['Close'].iloc[-1]
-            current_price_float = float(current_price_raw) # Ensure it's a float
-            print(f"Fetched Silver Price: {current_price_float} (Type: {type(current_price_float)})") # Log fetched value and type
-            return current_price_float
-        return None
-    except Exception as e:
-        print(f"Error fetching/processing silver price: {e}")
-        return None
+class PriceProvider(ABC):
+    """Fetches the latest price for a batch of tickers. Subclasses implement fetch(), which may block;
+    it is always run off the event loop. Tracks outcome counts and recent latencies, and has its own circuit breaker."""
+
+    name = "provider"
+    source = "Unknown"
+
+    def __init__(self, timeout_seconds: float = PRICE_PROVIDER_TIMEOUT_SECONDS):
+        self.timeout_seconds = timeout_seconds
+        self._latencies = deque(maxlen=PRICE_LATENCY_SAMPLES)
+        self.breaker = CircuitBreaker(self.name)
+        self._stats = {"fetches": 0, "successes": 0, "empty": 0, "errors": 0, "timeouts": 0, "hedges": 0}
+
+    @abstractmethod
+    def fetch(self, symbols: List[str]) -> dict:
+        """Returns {symbol: price} for the symbols it could price; may block."""
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging this provider, or None until enough latencies have been seen."""
+        if len(self._latencies) < PRICE_HEDGE_MIN_SAMPLES:
+            return None
+        return self.latency_quantile(0.95)
+
+    async def fetch_async(self, symbols: List[str]) -> dict:
+        """fetch() on a worker thread with this provider's timeout. Failures are counted and yield {};
+        so does a call while the breaker is open, without going upstream at all."""
+        if not self.breaker.allow():
+            self._count_errors(symbols, "short_circuit")
+            return {}
+        self._stats["fetches"] += 1
+        started = time.perf_counter()
+        try:
+            prices = await asyncio.wait_for(run_blocking(self.fetch, symbols), timeout=self.timeout_seconds)
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            self.breaker.record_failure()
+            self._count_errors(symbols, "timeout")
+            logger.warning(
+                "Price provider timed out", extra={"fields": {"provider": self.name, "timeout_seconds": self.timeout_seconds, "symbols": symbols}}
+            )
+            return {}
+        except Exception as e:
+            self._stats["errors"] += 1
+            self.breaker.record_failure()
+            self._count_errors(symbols, "error")
+            logger.warning("Error fetching prices: %s", e, extra={"fields": {"provider": self.name, "symbols": symbols}})
+            return {}
+        latency = time.perf_counter() - started
+        self._latencies.append(latency)
+        self._stats["successes" if prices else "empty"] += 1
+        if prices:
+            self.breaker.record_success()
+        elif len(symbols) > 1:
+            self.breaker.record_failure()
+        else:
+            # One symbol without data says more about that instrument than about the provider; the refresher
+            # backs off that symbol instead (RefreshSchedule.record_failure)
+            self.breaker.release_probe()
+        for symbol in symbols:
+            if symbol in prices:
+                upstream_fetch_duration_seconds.observe(latency, (self.name, symbol))
+        self._count_errors([symbol for symbol in symbols if symbol not in prices], "missing")
+        return prices
+
+    def _count_errors(self, symbols: List[str], kind: str):
+        for symbol in symbols:
+            upstream_fetch_errors_total.inc((self.name, symbol, kind))
+
+    def record_hedge(self):
+        self._stats["hedges"] += 1
+
+    def stats(self) -> dict:
+        p50, p95 = self.latency_quantile(0.5), self.latency_quantile(0.95)
+        return {
+            **self._stats,
+            "timeout_seconds": self.timeout_seconds,
+            "circuit": self.breaker.stats(),
+            "latency_p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 2) if p95 is not None else None
+        }
 
-async def fetch_live_palladium_price():
-    """Fetch current palladium price using yfinance"""
+def download_last_closes(symbols: List[str]) -> dict:
+    """Downloads all symbols in one multi-ticker yfinance call and returns the latest close per symbol."""
+    data = yf.download(symbols, period='1d', progress=False, group_by='column')
+    if data.empty:
+        return {}
+    closes = data['Close']
+    if not hasattr(closes, 'columns'): # Older yfinance returns a flat frame for a single ticker
+        closes = closes.to_frame(symbols[0])
+    prices = {}
+    for symbol in symbols:
+        if symbol not in closes.columns:
+            continue
+        series = closes[symbol].dropna()
+        if not series.empty:
+            prices[symbol] = float(series.iloc[-1]) # Ensure it's a float
+    return prices
+
+class YFinanceProvider(PriceProvider):
+    """Yahoo Finance futures quotes, all symbols in one batched download."""
+
+    name = "yfinance"
+    source = "Yahoo Finance"
+
+    def fetch(self, symbols: List[str]) -> dict:
+        return download_last_closes(symbols)
+
+class OfflineProvider(PriceProvider):
+    """Deterministic simulated prices for development, tests and benchmarks; never touches the network.
+    Each symbol moves by a small pseudo-random step derived from (symbol, time step), so every process
+    computes the same price for the same minute."""
+
+    name = "offline"
+    source = "Offline simulation"
+    BASE_PRICES = {
+        "GC=F": 2350.0, "SI=F": 29.5, "PA=F": 1000.0, "PL=F": 960.0, "HG=F": 4.4,
+        "EUR=X": 0.92, "GBP=X": 0.79, "CHF=X": 0.88, "JPY=X": 150.0, "CNY=X": 7.2,
+        "INR=X": 83.0, "AED=X": 3.6725, "CAD=X": 1.36, "AUD=X": 1.52
+    }
+    STEP_SECONDS = 60
+    MAX_MOVE = 0.02 # Largest deviation from the base price
+
+    def fetch(self, symbols: List[str]) -> dict:
+        step = int(time.time() // self.STEP_SECONDS)
+        prices = {}
+        for symbol in symbols:
+            digest = hashlib.blake2b(f"{symbol}:{step}".encode(), digest_size=8).digest()
+            unit = int.from_bytes(digest, "big") / 2**64 # Uniform in [0, 1)
+            base = self.BASE_PRICES.get(symbol, 100.0)
+            prices[symbol] = round(base * (1 + self.MAX_MOVE * (2 * unit - 1)), 4)
+        return prices
+
+PRICE_PROVIDER_TYPES = {provider.name: provider for provider in (YFinanceProvider, OfflineProvider)}
+PRICE_SOURCES = [provider.source for provider in PRICE_PROVIDER_TYPES.values()] # Shared cache slots store a source as its index here
+
+def build_price_providers(names: str) -> List[PriceProvider]:
+    providers = []
+    for name in (name.strip() for name in names.split(",")):
+        if name not in PRICE_PROVIDER_TYPES:
+            raise ValueError(f"Unknown price provider '{name}' in PRICE_PROVIDERS (known: {', '.join(PRICE_PROVIDER_TYPES)})")
+        providers.append(PRICE_PROVIDER_TYPES[name]())
+    # Simulated prices must never stand in for real ones behind a provider that is down
+    if len(providers) > 1 and any(isinstance(provider, OfflineProvider) for provider in providers):
+        raise ValueError("The offline price provider serves simulated prices; use it alone (PRICE_PROVIDERS=offline), not in a chain")
+    return providers
+
+price_providers = build_price_providers(PRICE_PROVIDERS)
+upstream_fetch_stats = {"batched_downloads": 0, "symbols_requested": 0, "hedges_won": 0, "fallbacks": 0, "unpriced": 0}
+
+async def _fetch_hedged(primary: PriceProvider, secondary: Optional[PriceProvider], symbols: List[str]):
+    """Yields (provider, prices) as answers arrive. The secondary is only started if hedging is on and
+    the primary is still running after its p95 latency."""
+    tasks = {asyncio.ensure_future(primary.fetch_async(symbols)): primary}
+    hedge_delay = primary.hedge_delay() if PRICE_HEDGING and secondary is not None else None
+    if hedge_delay is not None:
+        done, _ = await asyncio.wait(set(tasks), timeout=hedge_delay)
+        if not done:
+            secondary.record_hedge()
+            tasks[asyncio.ensure_future(secondary.fetch_async(symbols))] = secondary
+    pending = set(tasks)
     try:
-        palladium_data = yf.download('PA=F', period='1d')
-        if not palladium_data.empty:
-            current_price_raw = palladium_data['Close'].iloc[-1]
-            current_price_float = float(current_price_raw) # Ensure it's a float
-            print(f"Fetched Palladium Price: {current_price_float} (Type: {type(current_price_float)})") # Log fetched value and type
-            return current_price_float
-        return None
-    except Exception as e:
-        print(f"Error fetching/processing palladium price: {e}")
-        return None
-
-# --- Gold Price Endpoint (Still uses API Key Auth) ---
-# Note: This endpoint uses API Key Authentication.
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield tasks[task], task.result()
+    finally:
+        for task in pending: # The loser's thread finishes on its own; we just stop waiting for it
+            task.cancel()
+
+async def fetch_live_prices(symbols: List[str]):
+    """Prices symbols through the provider chain. Returns ({symbol: price}, {symbol: source name})."""
+    upstream_fetch_stats["batched_downloads"] += 1
+    upstream_fetch_stats["symbols_requested"] += len(symbols)
+    prices, sources = {}, {}
+    missing = list(symbols)
+    index = 0
+    while missing and index < len(price_providers):
+        primary = price_providers[index]
+        secondary = price_providers[index + 1] if index + 1 < len(price_providers) else None
+        if index > 0:
+            upstream_fetch_stats["fallbacks"] += 1
+        used = {primary}
+        answers = _fetch_hedged(primary, secondary, missing)
+        async for provider, result in answers:
+            used.add(provider)
+            if provider is not primary and result:
+                upstream_fetch_stats["hedges_won"] += 1
+            for symbol in missing:
+                if symbol in result:
+                    prices[symbol] = result[symbol]
+                    sources[symbol] = provider.source
+            missing = [symbol for symbol in missing if symbol not in prices]
+            if not missing:
+                break
+        await answers.aclose()
+        index += len(used)
+
+    logger.debug("Fetched prices", extra={"fields": {"prices": prices}})
+    if missing:
+        upstream_fetch_stats["unpriced"] += len(missing)
+        logger.warning("No price returned", extra={"fields": {"symbols": missing}})
+    return prices, sources
+
+
+# --- Price History (Time-series Store) ---
+# Every fetched price that differs from the last stored one for its symbol is appended to price_ticks,
+# and the matching OHLC bar at each resolution in price_bars is updated in the same transaction.
+# History queries read the rollups, so a year of daily bars is ~365 rows no matter how many ticks were stored.
+HISTORY_RESOLUTIONS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400} # Bucket width in seconds
+HISTORY_MAX_BARS = 5000
+PRICE_SOURCE = "Yahoo Finance"
+
+last_recorded_prices = {} # symbol -> last price written to price_ticks
+HISTORY_VERSION_BUMP_SQL = '''
+    INSERT INTO price_history_versions (symbol, version) VALUES (?, 1)
+    ON CONFLICT (symbol) DO UPDATE SET version = version + 1
+'''
+
+def bucket_start(timestamp: float, resolution: str) -> float:
+    width = HISTORY_RESOLUTIONS[resolution]
+    return float(int(timestamp // width) * width)
+
+def _record_price_ticks(conn, ticks: List[tuple]):
+    """Inserts (symbol, price, timestamp, source) ticks and folds them into the OHLC rollups, in one transaction."""
+    with conn:
+        conn.executemany("INSERT INTO price_ticks (symbol, price, timestamp, source) VALUES (?, ?, ?, ?)", ticks)
+        conn.executemany(
+            '''
+            INSERT INTO price_bars (symbol, resolution, bucket_start, open, high, low, close, tick_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT (symbol, resolution, bucket_start) DO UPDATE SET
+                high = MAX(high, excluded.high),
+                low = MIN(low, excluded.low),
+                close = excluded.close,
+                tick_count = tick_count + 1
+            ''',
+            [
+                (symbol, resolution, bucket_start(timestamp, resolution), price, price, price, price)
+                for symbol, price, timestamp, source in ticks
+                for resolution in HISTORY_RESOLUTIONS
+            ]
+        )
+        conn.executemany(HISTORY_VERSION_BUMP_SQL, [(symbol,) for symbol in {tick[0] for tick in ticks}])
 
-@app.get("/gold")
-async def get_gold_data(api_key: str = Header(...)):
-    conn = None # Initialize conn to None
+async def load_history_versions(symbols: tuple) -> tuple:
+    """The stored history version of each symbol (0 if none has been written), in the order given."""
+    rows = await db_fetch_all(
+        f"SELECT symbol, version FROM price_history_versions WHERE symbol IN ({', '.join('?' * len(symbols))})", symbols
+    )
+    versions = {row["symbol"]: row["version"] for row in rows}
+    return tuple(versions.get(symbol, 0) for symbol in symbols)
+
+async def record_price_changes(prices: dict, timestamp: float, sources: Optional[dict] = None):
+    """Persists the prices that changed since the last stored tick for their symbol, tagged with the provider's source."""
+    sources = sources or {}
+    ticks = [
+        (symbol, price, timestamp, sources.get(symbol, PRICE_SOURCE))
+        for symbol, price in prices.items()
+        if last_recorded_prices.get(symbol) != price
+    ]
+    if not ticks:
+        return
     try:
-        global gold_price_cache, gold_price_last_updated
-
-        # Validate API key
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # Check if key exists and is active
-        cursor.execute("SELECT id FROM api_keys WHERE key = ? AND is_active = 1", (api_key,))
-        key_record = cursor.fetchone()
+        await run_db(_record_price_ticks, ticks)
+        for symbol, price, _, _ in ticks:
+            last_recorded_prices[symbol] = price
+    except Exception as e:
+        logger.error("Error storing price ticks: %s", e, extra={"fields": {"symbols": [tick[0] for tick in ticks]}})
 
-        if not key_record:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API key")
+@app.on_event("startup")
+async def load_last_recorded_prices():
+    """Seeds the change detector from the database so a restart doesn't re-insert unchanged prices."""
+    rows = await db_fetch_all(
+        "SELECT symbol, price FROM price_ticks WHERE id IN (SELECT MAX(id) FROM price_ticks GROUP BY symbol)"
+    )
+    last_recorded_prices.update({row["symbol"]: row["price"] for row in rows})
+
+
+# --- Price Change Broadcasting ---
+# The refresher publishes each price change once; every streaming subscriber (SSE or WebSocket) gets it
+# through its own bounded queue. A slow consumer only loses its own oldest events, never blocks the others.
+STREAM_QUEUE_SIZE = 64
+STREAM_KEEPALIVE_SECONDS = 15
+
+class PriceBroadcaster:
+    """Single fan-out point for price-change events with per-subscriber drop-oldest backpressure."""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self) -> asyncio.Queue:
+        subscriber = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, name: str, event: dict):
+        message = json.dumps(event) # Serialized once, shared by every subscriber
+        self._stats["published"] += 1
+        for subscriber in self._subscribers:
+            if subscriber.full():
+                subscriber.get_nowait()
+                self._stats["dropped"] += 1
+            subscriber.put_nowait((name, message))
+            self._stats["delivered"] += 1
+
+    def stats(self) -> dict:
+        return {**self._stats, "subscribers": len(self._subscribers)}
+
+price_broadcaster = PriceBroadcaster(STREAM_QUEUE_SIZE)
+
+def price_event(name: str, snapshot: dict) -> dict:
+    return {
+        "type": "price",
+        "name": name,
+        "symbol": COMMODITIES[name]["symbol"],
+        "price": snapshot["price"],
+        "currency": "USD",
+        "unit": COMMODITIES[name]["unit"],
+        "source": snapshot["source"],
+        "last_updated": snapshot["last_updated"].timestamp()
+    }
+
+
+# --- Single-flight Upstream Fetches ---
+# When several callers want the same symbol at once (the refresher plus requests arriving on a cold cache),
+# only the first one goes upstream; everyone else awaits that same in-flight fetch.
+
+class SingleFlight:
+    """Collapses concurrent calls for the same keys into one in-flight call whose result every caller shares."""
+
+    def __init__(self):
+        self._in_flight = {}
+        self._stats = {}
+
+    async def run(self, keys: List[str], fetch_batch) -> dict:
+        """Returns {key: result} for keys. Keys without an in-flight call are fetched together in one fetch_batch(keys) call."""
+        waiting = {}
+        missing = []
+        for key in keys:
+            stats = self._stats.setdefault(key, {"fetches": 0, "coalesced": 0})
+            task = self._in_flight.get(key)
+            if task is None:
+                stats["fetches"] += 1
+                missing.append(key)
+            else:
+                stats["coalesced"] += 1
+                waiting[key] = task
+        if missing:
+            task = asyncio.ensure_future(fetch_batch(missing))
+            for key in missing:
+                self._in_flight[key] = task
+                waiting[key] = task
+                task.add_done_callback(functools.partial(self._forget, key))
+
+        results = {}
+        for task in set(waiting.values()):
+            # Shield so a cancelled waiter doesn't cancel the fetch the other waiters depend on
+            batch_result = await asyncio.shield(task)
+            for key, value in batch_result.items():
+                if key in waiting:
+                    results[key] = value
+        return results
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            key: {**counts, "in_flight": key in self._in_flight}
+            for key, counts in self._stats.items()
+        }
 
-        # Log key usage
-        await log_key_usage(api_key)
+price_fetches = SingleFlight()
+
+def store_price(name: str, price: float, last_updated: datetime, source: str):
+    """Installs a new snapshot for name and announces it to stream subscribers if the price moved."""
+    previous = price_cache.get(name)
+    refresh_schedule.observe(name, price, last_updated.timestamp())
+    price_cache[name] = new_price_snapshot(name, price, last_updated, source)
+    if previous is None or previous["price"] != price:
+        price_broadcaster.publish(name, price_event(name, price_cache[name]))
+
+async def _refresh_symbols(symbols: List[str]) -> dict:
+    # FX rates ride along in the same batched download whenever they are due
+    fx_symbols = list(FX_SYMBOLS.values()) if fx_rates_due() else []
+    prices, sources = await fetch_live_prices(symbols + fx_symbols)
+    # Counted here, once per upstream fetch, not by each caller that joined it through price_fetches
+    for symbol in symbols:
+        if symbol not in prices:
+            refresh_schedule.record_failure(SYMBOL_TO_COMMODITY[symbol]) # Backs off instead of retrying every second
+    now = datetime.now()
+    rates = {symbol: prices.pop(symbol) for symbol in fx_symbols if symbol in prices}
+    if rates:
+        store_fx_rates(rates, now.timestamp())
+        if shared_price_cache is not None:
+            for symbol, rate in rates.items():
+                shared_price_cache.write(symbol, rate, now.timestamp(), sources[symbol])
+    for symbol, price in prices.items():
+        store_price(SYMBOL_TO_COMMODITY[symbol], price, now, sources[symbol])
+        if shared_price_cache is not None:
+            shared_price_cache.write(symbol, price, now.timestamp(), sources[symbol])
+    build_price_matrix() # One vectorized pass per refresh, so requests only look prices up
+    await record_price_changes(prices, now.timestamp(), sources)
+    return prices
+
+async def refresh_prices(names: Optional[List[str]] = None) -> dict:
+    """Refreshes the given commodities (default: all) through the shared single-flight layer."""
+    names = list(COMMODITIES) if names is None else names
+    if not names:
+        return {}
+    return await price_fetches.run([COMMODITIES[name]["symbol"] for name in names], _refresh_symbols)
+
+
+# --- Cross-worker Shared Price Cache ---
+# With several uvicorn workers each process would otherwise poll Yahoo on its own. Instead, the workers
+# on a host share a memory-mapped table with one fixed-size slot per ticker. A worker that holds an
+# exclusive flock on "<path>.leader" is the only one that fetches and writes it; the OS drops the lock
+# when that process exits, and the next worker to try takes over. Every slot is guarded by a seqlock:
+# the writer makes the sequence odd, writes, then makes it even again, so readers never lock, they just
+# retry when they saw an odd or changed sequence.
+SHARED_PRICE_SYNC_INTERVAL_SECONDS = 1.0 # How often followers copy new values into their local snapshots
+SHARED_PRICE_COLD_WAIT_SECONDS = 5.0 # How long a follower request waits for the leader's first fetch
+SHARED_PRICE_READ_RETRIES = 100
+
+class SharedPriceCache:
+    """Seqlocked price table in a memory-mapped file, written by one elected worker and read by all."""
+
+    MAGIC = b"PXSHM003"
+    HEADER = struct.Struct("<8s8s") # magic, hash of the ticker layout
+    AUTH = struct.Struct("<Q") # auth invalidation generation, right after the header
+    SLOT = struct.Struct("<QddH") # sequence, price, last_updated (Unix time), 1 + index in PRICE_SOURCES (0: unknown)
+
+    def __init__(self, path: str, symbols: List[str]):
+        self.path = path
+        self.symbols = sorted(symbols)
+        self.layout = hashlib.blake2b("\n".join(self.symbols).encode(), digest_size=8).digest()
+        slots_start = self.HEADER.size + self.AUTH.size
+        self.size = slots_start + self.SLOT.size * len(self.symbols)
+        self._offsets = {symbol: slots_start + index * self.SLOT.size for index, symbol in enumerate(self.symbols)}
+        self._map = None
+        self._leader_file = None
+        self._auth_lock_file = None
+        self._installed = {} # symbol -> sequence last copied into the local price cache
+        self.is_leader = False
+        self._stats = {"writes": 0, "reads": 0, "read_retries": 0, "synced": 0, "leader_elections": 0}
+
+    def open(self):
+        import fcntl
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Serialize layout checks so two workers starting together don't both (re)initialize the file
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != self.size or os.pread(fd, self.HEADER.size, 0) != self.HEADER.pack(self.MAGIC, self.layout):
+                    # New file, or one laid out for another registry: zero every slot, then stamp the layout
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, bytes(self.size), 0)
+                    os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.layout), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd) # The mapping stays valid after the descriptor is closed
+        self._leader_file = open(self.path + ".leader", "a+")
+        self._auth_lock_file = open(self.path + ".auth", "a+")
+
+    def try_lead(self) -> bool:
+        """Becomes the writer if no other live worker is; cheap to call repeatedly."""
+        if self.is_leader:
+            return True
+        import fcntl
+        try:
+            fcntl.flock(self._leader_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._leader_file.truncate(0)
+        self._leader_file.write(str(os.getpid()))
+        self._leader_file.flush()
+        self.is_leader = True
+        self._stats["leader_elections"] += 1
+        return True
+
+    def write(self, symbol: str, price: float, last_updated: float, source: str):
+        offset = self._offsets.get(symbol)
+        if offset is None:
+            return
+        sequence = struct.unpack_from("<Q", self._map, offset)[0]
+        if sequence % 2: # A previous leader died mid-write; move past its odd value
+            sequence += 1
+        struct.pack_into("<Q", self._map, offset, sequence + 1)
+        source_id = PRICE_SOURCES.index(source) + 1 if source in PRICE_SOURCES else 0
+        struct.pack_into("<ddH", self._map, offset + 8, price, last_updated, source_id)
+        struct.pack_into("<Q", self._map, offset, sequence + 2)
+        self._installed[symbol] = sequence + 2
+        self._stats["writes"] += 1
+
+    def read(self, symbol: str) -> Optional[tuple]:
+        """Returns (sequence, price, last_updated, source) for symbol, or None if it was never written."""
+        offset = self._offsets.get(symbol)
+        if offset is None:
+            return None
+        self._stats["reads"] += 1
+        for _ in range(SHARED_PRICE_READ_RETRIES):
+            sequence = struct.unpack_from("<Q", self._map, offset)[0]
+            if sequence % 2 == 0:
+                price, last_updated, source_id = struct.unpack_from("<ddH", self._map, offset + 8)
+                if struct.unpack_from("<Q", self._map, offset)[0] == sequence:
+                    source = PRICE_SOURCES[source_id - 1] if 0 < source_id <= len(PRICE_SOURCES) else PriceProvider.source
+                    return (sequence, price, last_updated, source) if sequence else None
+            self._stats["read_retries"] += 1
+        return None
 
-        # Check if cache is expired (older than 1 minute)
-        if (gold_price_last_updated is None or
-            (datetime.now() - gold_price_last_updated) > timedelta(minutes=1)):
-            # Fetch fresh price
-            gold_price = await fetch_live_gold_price()
-            if gold_price is not None:
-                gold_price_cache = gold_price
-                gold_price_last_updated = datetime.now()
+    def sync(self, names: List[str]) -> List[str]:
+        """Copies slots the leader has rewritten since the last sync into the local cache; returns the names updated."""
+        updated = []
+        for name in names:
+            symbol = COMMODITIES[name]["symbol"]
+            slot = self.read(symbol)
+            if slot is None or slot[0] == self._installed.get(symbol):
+                continue
+            sequence, price, last_updated, source = slot
+            store_price(name, price, datetime.fromtimestamp(last_updated), source)
+            self._installed[symbol] = sequence
+            updated.append(name)
+        self._stats["synced"] += len(updated)
+        return updated
+
+    def sync_fx(self) -> bool:
+        """Copies FX rates the leader has rewritten since the last sync; returns whether any changed."""
+        rates = {}
+        last_updated = 0.0
+        for symbol in FX_SYMBOLS.values():
+            slot = self.read(symbol)
+            if slot is None or slot[0] == self._installed.get(symbol):
+                continue
+            rates[symbol] = slot[1]
+            last_updated = max(last_updated, slot[2])
+            self._installed[symbol] = slot[0]
+        if rates:
+            store_fx_rates(rates, last_updated)
+        return bool(rates)
+
+    def auth_generation(self) -> Optional[int]:
+        """The shared auth invalidation generation, or None before the table is opened."""
+        if self._map is None:
+            return None
+        return self.AUTH.unpack_from(self._map, self.HEADER.size)[0]
+
+    def bump_auth_generation(self):
+        """Tells every worker to drop its cached keys and principals. Any worker may call this, so the
+        read-increment-write happens under a lock file to never lose a bump."""
+        if self._map is None:
+            return
+        import fcntl
+        fcntl.flock(self._auth_lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            self.AUTH.pack_into(self._map, self.HEADER.size, self.AUTH.unpack_from(self._map, self.HEADER.size)[0] + 1)
+        finally:
+            fcntl.flock(self._auth_lock_file.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        if self._auth_lock_file is not None:
+            self._auth_lock_file.close()
+            self._auth_lock_file = None
+        if self._leader_file is not None:
+            self._leader_file.close() # Releases the leader lock, so another worker can take over right away
+            self._leader_file = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.is_leader = False
+
+    def stats(self) -> dict:
+        return {**self._stats, "path": self.path, "is_leader": self.is_leader, "pid": os.getpid()}
+
+shared_price_cache = SharedPriceCache(
+    SHARED_PRICE_CACHE_PATH, [spec["symbol"] for spec in COMMODITIES.values()] + list(FX_SYMBOLS.values())
+) if SHARED_PRICE_CACHE_PATH else None
+
+def is_price_follower() -> bool:
+    """True when another worker owns upstream fetching and this one only reads the shared table."""
+    return shared_price_cache is not None and not shared_price_cache.is_leader
+
+async def wait_for_shared_prices(names: List[str]):
+    """Follower cold path: picks up names from the shared table, waiting briefly for the leader's first fetch."""
+    deadline = time.monotonic() + SHARED_PRICE_COLD_WAIT_SECONDS
+    while True:
+        shared_price_cache.sync(names)
+        shared_price_cache.sync_fx()
+        if all(name in price_cache for name in names) or time.monotonic() >= deadline:
+            return
+        await asyncio.sleep(0.05)
 
-        if gold_price_cache is None:
-            raise HTTPException(status_code=503, detail="Unable to fetch gold price")
+@app.on_event("startup")
+def open_shared_price_cache():
+    if shared_price_cache is not None:
+        shared_price_cache.open()
+
+
+# --- Adaptive Refresh Schedule ---
+# Polling every symbol once a minute around the clock wastes upstream calls when nothing can move (weekends,
+# the daily CME maintenance break, holidays) and lags when markets move fast. Instead each symbol follows
+# its instrument's trading calendar and its own recent volatility:
+#   market closed: refresh every PRICE_REFRESH_CLOSED_INTERVAL_SECONDS, and again right at the next open
+#   market open:   interval = base * (target move / typical move per base interval)^2, clamped to
+#                  [PRICE_REFRESH_MIN_INTERVAL_SECONDS, PRICE_REFRESH_MAX_INTERVAL_SECONDS]
+# Prices roughly follow a random walk, so the typical move over t seconds grows with sqrt(t); the formula picks
+# the interval over which a typical move is PRICE_REFRESH_TARGET_MOVE_BPS. Quiet symbols back off, fast ones
+# tighten. Until a symbol has moved at least once while open it uses the base interval.
+PRICE_REFRESH_SCHEDULE = os.environ.get("PRICE_REFRESH_SCHEDULE", "adaptive") # "adaptive", or "fixed" for the base interval
+PRICE_REFRESH_MIN_INTERVAL_SECONDS = float(os.environ.get("PRICE_REFRESH_MIN_INTERVAL_SECONDS", "15"))
+PRICE_REFRESH_MAX_INTERVAL_SECONDS = float(os.environ.get("PRICE_REFRESH_MAX_INTERVAL_SECONDS", "300"))
+PRICE_REFRESH_CLOSED_INTERVAL_SECONDS = float(os.environ.get("PRICE_REFRESH_CLOSED_INTERVAL_SECONDS", "1800"))
+PRICE_REFRESH_TARGET_MOVE_BPS = float(os.environ.get("PRICE_REFRESH_TARGET_MOVE_BPS", "3"))
+PRICE_VOLATILITY_SMOOTHING = 0.2 # EWMA weight of the newest observed move
+# A symbol whose fetch failed is retried after this backoff, doubling per consecutive failure (with jitter)
+# up to the max, instead of counting as due again right away
+PRICE_REFRESH_RETRY_SECONDS = float(os.environ.get("PRICE_REFRESH_RETRY_SECONDS", "15"))
+PRICE_REFRESH_MAX_RETRY_SECONDS = float(os.environ.get("PRICE_REFRESH_MAX_RETRY_SECONDS", "300"))
+# Exchange-local dates without trading, e.g. MARKET_HOLIDAYS=2026-12-25,2027-01-01
+MARKET_HOLIDAYS = {day.strip() for day in os.environ.get("MARKET_HOLIDAYS", "").split(",") if day.strip()}
+
+if PRICE_REFRESH_SCHEDULE not in ("adaptive", "fixed"):
+    raise ValueError(f"Unknown PRICE_REFRESH_SCHEDULE '{PRICE_REFRESH_SCHEDULE}' (known: adaptive, fixed)")
+
+# Weekly sessions in exchange-local time as (open weekday, "HH:MM", close weekday, "HH:MM"), Monday = 0.
+# CME Globex metals trade from Sunday 18:00 to Friday 17:00 New York time, with a daily 17:00-18:00 break.
+TRADING_CALENDARS = {
+    "cme_globex": {
+        "timezone": "America/New_York",
+        "sessions": [(6, "18:00", 0, "17:00")] + [(day, "18:00", day + 1, "17:00") for day in range(4)],
+    },
+    "always": None, # Trades around the clock
+}
+
+class MarketCalendar:
+    """Open/closed state of a weekly session calendar, resolved to the minute (and memoized per minute)."""
+
+    WEEK_MINUTES = 7 * 24 * 60
+
+    def __init__(self, timezone: str, sessions: list, holidays: set):
+        self.tz = zoneinfo.ZoneInfo(timezone)
+        self.holidays = holidays
+        self.opens = []
+        self.ranges = [] # (first minute of week, minute after the last), split where a session wraps past Sunday
+        for open_day, open_time, close_day, close_time in sessions:
+            start = open_day * 1440 + self._minute_of_day(open_time)
+            end = close_day * 1440 + self._minute_of_day(close_time)
+            self.opens.append(start)
+            self.ranges.extend([(start, end)] if start < end else [(start, self.WEEK_MINUTES), (0, end)])
+        self._memo = (None, None)
+
+    @staticmethod
+    def _minute_of_day(hhmm: str) -> int:
+        hours, minutes = hhmm.split(":")
+        return int(hours) * 60 + int(minutes)
+
+    def _is_open_local(self, local: datetime) -> bool:
+        if local.date().isoformat() in self.holidays:
+            return False
+        minute = local.weekday() * 1440 + local.hour * 60 + local.minute
+        return any(start <= minute < end for start, end in self.ranges)
+
+    def is_open(self, timestamp: float) -> bool:
+        minute = int(timestamp // 60)
+        if self._memo[0] != minute:
+            self._memo = (minute, self._is_open_local(datetime.fromtimestamp(timestamp, self.tz)))
+        return self._memo[1]
+
+    def next_open(self, timestamp: float) -> Optional[float]:
+        """First minute after timestamp at which the market is open. Checks each session open and each
+        local midnight (where a holiday ends) in turn; None if nothing opens within ~two months."""
+        local = datetime.fromtimestamp(timestamp, self.tz).replace(second=0, microsecond=0)
+        for _ in range(128):
+            minute_of_day = local.hour * 60 + local.minute
+            minute = local.weekday() * 1440 + minute_of_day
+            step = min((start - minute - 1) % self.WEEK_MINUTES + 1 for start in self.opens)
+            local += timedelta(minutes=min(step, 1440 - minute_of_day)) # Wall-clock arithmetic, so DST-safe
+            if self._is_open_local(local):
+                return local.timestamp()
+        return None
 
+market_calendars = {
+    name: MarketCalendar(spec["timezone"], spec["sessions"], MARKET_HOLIDAYS)
+    for name, spec in TRADING_CALENDARS.items() if spec is not None
+}
+
+# The calendar each commodity trades on; None for round-the-clock instruments
+commodity_calendars = {
+    name: market_calendars.get(spec.get("calendar", "cme_globex" if spec["symbol"].endswith("=F") else "always"))
+    for name, spec in COMMODITIES.items()
+}
+
+class RefreshSchedule:
+    """Per-symbol refresh intervals from trading hours and observed volatility, plus how many refreshes the
+    schedule made compared with a fixed base-interval poll."""
+
+    def __init__(self):
+        self._last = {} # name -> (price, timestamp) of the last observed snapshot
+        self._failures = {} # name -> consecutive failed fetches
+        self._retry_at = {} # name -> Unix time before which a failed symbol isn't due again
+        self._volatility = {} # name -> EWMA of the absolute move in bps, scaled to one base interval
+        self._refreshes = {} # name -> snapshots observed (one per successful fetch)
+        self._started = time.time()
+
+    def observe(self, name: str, price: float, timestamp: float):
+        """Feeds a newly stored price into the symbol's volatility estimate."""
+        self._refreshes[name] = self._refreshes.get(name, 0) + 1
+        self._failures.pop(name, None)
+        self._retry_at.pop(name, None)
+        last = self._last.get(name)
+        self._last[name] = (price, timestamp)
+        if last is None or last[0] <= 0 or price <= 0 or timestamp <= last[1]:
+            return
+        calendar = commodity_calendars[name]
+        if calendar is not None and not (calendar.is_open(last[1]) and calendar.is_open(timestamp)):
+            return # Flat prices while closed (or the gap across a close) say nothing about the next session
+        elapsed = max(timestamp - last[1], 1.0)
+        move = abs(math.log(price / last[0])) * 10000 / math.sqrt(elapsed / PRICE_REFRESH_INTERVAL_SECONDS)
+        previous = self._volatility.get(name)
+        self._volatility[name] = move if previous is None else previous + PRICE_VOLATILITY_SMOOTHING * (move - previous)
+
+    def refreshes(self, name: str) -> int:
+        return self._refreshes.get(name, 0)
+
+    def in_backoff(self, name: str, now: Optional[float] = None) -> bool:
+        """True while a failed symbol waits out its retry backoff."""
+        return (time.time() if now is None else now) < self._retry_at.get(name, 0.0)
+
+    def record_failure(self, name: str):
+        """A fetch for name came back without a price; back off before it is due again."""
+        failures = self._failures[name] = self._failures.get(name, 0) + 1
+        backoff = min(PRICE_REFRESH_RETRY_SECONDS * 2 ** (failures - 1), PRICE_REFRESH_MAX_RETRY_SECONDS)
+        self._retry_at[name] = time.time() + random.uniform(backoff / 2, backoff)
+
+    def interval(self, name: str, now: Optional[float] = None) -> float:
+        if PRICE_REFRESH_SCHEDULE == "fixed":
+            return PRICE_REFRESH_INTERVAL_SECONDS
+        calendar = commodity_calendars[name]
+        if calendar is not None and not calendar.is_open(time.time() if now is None else now):
+            return PRICE_REFRESH_CLOSED_INTERVAL_SECONDS
+        volatility = self._volatility.get(name)
+        if volatility is None:
+            return PRICE_REFRESH_INTERVAL_SECONDS
+        if volatility <= 0:
+            return PRICE_REFRESH_MAX_INTERVAL_SECONDS
+        interval = PRICE_REFRESH_INTERVAL_SECONDS * (PRICE_REFRESH_TARGET_MOVE_BPS / volatility) ** 2
+        return min(max(interval, PRICE_REFRESH_MIN_INTERVAL_SECONDS), PRICE_REFRESH_MAX_INTERVAL_SECONDS)
+
+    def next_due(self, name: str, last_updated: Optional[float], now: Optional[float] = None) -> float:
+        """When a snapshot taken at last_updated (None: never fetched) should be refreshed. Never later than the
+        next market open, and never before the retry backoff of a failed fetch has passed."""
+        now = time.time() if now is None else now
+        if last_updated is None:
+            due = now
+        else:
+            due = last_updated + self.interval(name, now)
+            calendar = commodity_calendars[name]
+            if PRICE_REFRESH_SCHEDULE == "adaptive" and calendar is not None and not calendar.is_open(now):
+                next_open = calendar.next_open(now)
+                if next_open is not None:
+                    due = min(due, next_open)
+        return max(due, self._retry_at.get(name, 0.0))
+
+    def stats(self) -> dict:
+        now = time.time()
+        symbols = {}
+        for name in COMMODITIES:
+            calendar = commodity_calendars[name]
+            snapshot = price_cache.get(name)
+            volatility = self._volatility.get(name)
+            symbols[name] = {
+                "interval_seconds": round(self.interval(name, now), 1),
+                "next_refresh_in_seconds": round(max(0.0, self.next_due(name, snapshot["last_updated"].timestamp() if snapshot else None, now) - now), 1),
+                "market_open": calendar is None or calendar.is_open(now),
+                "volatility_bps": round(volatility, 3) if volatility is not None else None,
+                "refreshes": self.refreshes(name),
+                "consecutive_failures": self._failures.get(name, 0),
+            }
+        refreshes = sum(self._refreshes.values())
+        fixed_refreshes = len(COMMODITIES) * (1 + int((now - self._started) // PRICE_REFRESH_INTERVAL_SECONDS))
         return {
-            "gold_price": gold_price_cache,
-            "currency": "USD",
-            "last_updated": gold_price_last_updated.timestamp(),
-            "unit": "per troy ounce",
-            "source": "live market data"
+            "mode": PRICE_REFRESH_SCHEDULE,
+            "refreshes": refreshes,
+            "fixed_interval_refreshes": fixed_refreshes, # What polling every symbol each base interval would have made
+            "refreshes_saved": max(0, fixed_refreshes - refreshes),
+            "symbols": symbols,
         }
-    except HTTPException as http_exc: # Re-raise HTTP exceptions
-        raise http_exc
-    except HTTPException as http_exc: # Re-raise HTTP exceptions
-        raise http_exc
-    except HTTPException as http_exc: # Re-raise HTTP exceptions
-        raise http_exc
-    except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in get_gold_data for key {api_key[:8]}... !!!") # Avoid logging full key
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching gold data.")
-    finally:
-        if conn:
-            conn.close()
 
+refresh_schedule = RefreshSchedule()
 
-# --- Dashboard Prices Endpoint (Uses JWT Auth) ---
-@app.get("/dashboard/prices")
-async def get_dashboard_prices(current_user: dict = Depends(get_current_user)):
-    """Fetches all commodity prices for the authenticated dashboard user."""
-    # No API key validation or usage logging needed here, as auth is handled by JWT.
-    # We rely on the caching logic within the individual price endpoints being called internally,
-    # or we could implement caching directly here if preferred. For simplicity, let's call them.
-    # Note: This approach might log usage multiple times if the user also uses the direct API key endpoints.
-    # A more robust solution might involve separate internal fetching functions without logging.
 
-    # We still need access to the global cache variables if we want to check them here
-    global gold_price_cache, gold_price_last_updated
-    global silver_price_cache, silver_price_last_updated
-    global palladium_price_cache, palladium_price_last_updated
+# --- Background Price Refresher ---
+# Request handlers never call the fetchers directly; they only read the in-memory snapshot
+# that this task keeps up to date, so upstream latency stays off the request path.
 
-    prices = {}
-    errors = {}
+def price_is_due(name: str) -> bool:
+    snapshot = price_cache.get(name)
+    # Small slack so a symbol refreshed a moment late isn't skipped until the next cycle
+    return time.time() >= refresh_schedule.next_due(name, snapshot["last_updated"].timestamp() if snapshot else None) - 1
 
-    # Fetch Gold
+def seconds_until_next_refresh() -> float:
+    """How long the refresher may sleep before a symbol is due: at least a second, and at most one base
+    interval so a schedule change (e.g. a market opening) is picked up within that. While every provider's
+    breaker is open it waits for the first one to allow a probe."""
+    now = time.time()
+    due = min(
+        refresh_schedule.next_due(name, price_cache[name]["last_updated"].timestamp() if name in price_cache else None, now)
+        for name in COMMODITIES
+    )
+    upstream_wait = min((provider.breaker.retry_in() for provider in price_providers), default=0.0)
+    return min(max(due - now, upstream_wait, 1.0), PRICE_REFRESH_INTERVAL_SECONDS)
+
+async def refresh_due_prices():
+    """Refreshes every due commodity in one batch. A failed fetch keeps the previous value in place."""
+    global price_refresh_in_progress
+    price_refresh_in_progress = True
     try:
-        if (gold_price_last_updated is None or
-            (datetime.now() - gold_price_last_updated) > timedelta(minutes=1)):
-            gold_price = await fetch_live_gold_price()
-            if gold_price is not None:
-                gold_price_cache = gold_price
-                gold_price_last_updated = datetime.now()
-        if gold_price_cache is not None:
-             prices["gold"] = {
-                 "price": gold_price_cache,
-                 "currency": "USD",
-                 "last_updated": gold_price_last_updated.timestamp(),
-                 "unit": "per troy ounce",
-                 "source": "live market data"
-             }
-        else:
-            errors["gold"] = "Unable to fetch gold price"
-    except Exception as e:
-        print(f"Error fetching gold for dashboard: {e}")
-        errors["gold"] = "Error fetching gold price"
+        await refresh_prices([name for name in COMMODITIES if price_is_due(name)])
+    finally:
+        price_refresh_in_progress = False
+
+async def price_refresher_loop():
+    while True:
+        interval = PRICE_REFRESH_INTERVAL_SECONDS
+        try:
+            if shared_price_cache is not None and not shared_price_cache.try_lead():
+                # Another worker fetches; just follow the shared table (and keep trying to take over)
+                shared_price_cache.sync(list(COMMODITIES))
+                shared_price_cache.sync_fx()
+                interval = SHARED_PRICE_SYNC_INTERVAL_SECONDS
+            else:
+                await refresh_due_prices()
+                interval = seconds_until_next_refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Unexpected error in price refresher")
+        await asyncio.sleep(interval)
 
-    # Fetch Silver
+@app.on_event("startup")
+async def warm_price_cache():
+    """Fills the price cache before the worker reports ready, so the first price request is served from
+    memory. Registered after init_db and the shared-cache setup, and before the refresher starts (which
+    then finds every price fresh). Up to PRICE_WARMUP_TIMEOUT_SECONDS; 0 skips it."""
+    if PRICE_WARMUP_TIMEOUT_SECONDS <= 0:
+        return
+    started = time.perf_counter()
     try:
-        if (silver_price_last_updated is None or
-            (datetime.now() - silver_price_last_updated) > timedelta(minutes=1)):
-            silver_price = await fetch_live_silver_price()
-            if silver_price is not None:
-                silver_price_cache = silver_price
-                silver_price_last_updated = datetime.now()
-        if silver_price_cache is not None:
-            prices["silver"] = {
-                "price": silver_price_cache,
-                "currency": "USD",
-                "last_updated": silver_price_last_updated.timestamp(),
-                "unit": "per troy ounce",
-                "source": "live market data"
-            }
+        if shared_price_cache is not None and not shared_price_cache.try_lead():
+            await wait_for_shared_prices(list(COMMODITIES))
         else:
-             errors["silver"] = "Unable to fetch silver price"
-    except Exception as e:
-        print(f"Error fetching silver for dashboard: {e}")
-        errors["silver"] = "Error fetching silver price"
+            # Past the timeout the fetch keeps running in the single-flight layer; early requests join it
+            await asyncio.wait_for(refresh_prices(), timeout=PRICE_WARMUP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Price cache warm-up timed out", extra={"fields": {"timeout_seconds": PRICE_WARMUP_TIMEOUT_SECONDS}})
+    logger.info("Price cache warmed", extra={"fields": {
+        "cached": len(price_cache), "commodities": len(COMMODITIES), "seconds": round(time.perf_counter() - started, 3)
+    }})
+    # Only /analytics needs these; load them off the event loop now rather than on its first request
+    loop = asyncio.get_running_loop()
+    for module in (np, pd):
+        loop.run_in_executor(None, module.load)
 
-    # Fetch Palladium
-    try:
-        if (palladium_price_last_updated is None or
-            (datetime.now() - palladium_price_last_updated) > timedelta(minutes=1)):
-            palladium_price = await fetch_live_palladium_price()
-            if palladium_price is not None:
-                palladium_price_cache = palladium_price
-                palladium_price_last_updated = datetime.now()
-        if palladium_price_cache is not None:
-            prices["palladium"] = {
-                "price": palladium_price_cache,
-                "currency": "USD",
-                "last_updated": palladium_price_last_updated.timestamp(),
-                "unit": "per troy ounce",
-                "source": "live market data"
-            }
+@app.on_event("startup")
+async def start_price_refresher():
+    global price_refresher_task
+    price_refresher_task = asyncio.create_task(price_refresher_loop())
+
+@app.on_event("shutdown")
+async def stop_price_refresher():
+    global price_refresher_task
+    if price_refresher_task:
+        price_refresher_task.cancel()
+        try:
+            await price_refresher_task
+        except asyncio.CancelledError:
+            pass
+        price_refresher_task = None
+    if shared_price_cache is not None:
+        shared_price_cache.close()
+
+def price_age_seconds(snapshot: dict) -> float:
+    return (datetime.now() - snapshot["last_updated"]).total_seconds()
+
+def price_is_stale(snapshot: dict) -> bool:
+    return price_age_seconds(snapshot) > PRICE_STALE_AFTER_INTERVALS * refresh_schedule.interval(snapshot["name"])
+
+async def get_price_snapshots(names: List[str]) -> dict:
+    """Returns cached snapshots for names. Anything not cached yet (e.g. right after startup) joins one shared fetch,
+    unless its last fetch failed and it is still backing off; then it is left out at once rather than waited on."""
+    cold = [name for name in names if name not in price_cache]
+    for name in names:
+        price_cache_lookups_total.inc((COMMODITIES[name]["symbol"], "miss" if name in cold else "hit"))
+    if cold:
+        if is_price_follower():
+            await wait_for_shared_prices(cold)
         else:
-             errors["palladium"] = "Unable to fetch palladium price"
+            now = time.time()
+            await refresh_prices([name for name in cold if not refresh_schedule.in_backoff(name, now)])
+    return {name: price_cache[name] for name in names if name in price_cache}
+
+def price_payload(
+    name: str, snapshot: dict, price_field: str = "price", stale: bool = False,
+    currency: str = "USD", unit: Optional[str] = None
+) -> dict:
+    return {
+        price_field: quoted_price(name, snapshot, currency, unit),
+        "currency": currency,
+        "last_updated": snapshot["last_updated"].timestamp(),
+        "unit": PRICE_UNITS[unit][0] if unit else COMMODITIES[name]["unit"],
+        "source": snapshot["source"], # The provider that answered, e.g. "Yahoo Finance" or "Offline simulation"
+        "stale": stale
+    }
+
+
+# --- Currency and Unit Conversion ---
+# Every refresh builds the full commodities x currencies x units price table in one vectorized NumPy step
+# from the USD snapshots and the latest FX rates. Requests for a converted quote just index into it; the
+# default (USD, the commodity's own unit) is the snapshot price itself. Unit conversion goes through grams,
+# so a commodity whose unit isn't a known mass (e.g. an EXTRA_COMMODITIES "per metric ton") is only quoted
+# in its own unit.
+fx_rates = {"USD": 1.0} # currency -> units of it per US dollar
+fx_state = {"version": 0, "last_updated": None}
+UNIT_BY_LABEL = {label: unit for unit, (label, _) in PRICE_UNITS.items()}
+COMMODITY_INDEX = {name: index for index, name in enumerate(COMMODITIES)}
+CURRENCY_INDEX = {currency: index for index, currency in enumerate(PRICE_CURRENCIES)}
+UNIT_INDEX = {unit: index + 1 for index, unit in enumerate(PRICE_UNITS)} # Column 0 is each commodity's own unit
+
+def native_unit(name: str) -> Optional[str]:
+    """The PRICE_UNITS key of a commodity's quoted unit, or None if it isn't a known mass unit."""
+    return UNIT_BY_LABEL.get(COMMODITIES[name]["unit"])
+
+def build_unit_factors():
+    """[commodity, unit column] multipliers from each commodity's own unit; NaN where there is no conversion."""
+    unit_grams = np.array([grams for _, grams in PRICE_UNITS.values()], dtype=float)
+    native_grams = np.array(
+        [PRICE_UNITS[native_unit(name)][1] if native_unit(name) else np.nan for name in COMMODITIES], dtype=float
+    )
+    return np.hstack([np.ones((len(COMMODITIES), 1)), unit_grams[None, :] / native_grams[:, None]])
+
+# stamp: (snapshot counter, FX version) the table was built from; versions: snapshot version per row
+price_matrix = {"stamp": None, "versions": None, "prices": None, "unit_factors": None}
+
+def fx_rates_due() -> bool:
+    last_updated = fx_state["last_updated"]
+    return last_updated is None or time.time() - last_updated >= PRICE_REFRESH_INTERVAL_SECONDS - 1
+
+def store_fx_rates(rates: dict, last_updated: float):
+    """Installs fetched FX rates ({"EUR=X": 0.92, ...}); a changed rate invalidates converted responses."""
+    changed = False
+    for currency, symbol in FX_SYMBOLS.items():
+        rate = rates.get(symbol)
+        if rate is not None and rate > 0 and fx_rates.get(currency) != rate:
+            fx_rates[currency] = rate
+            changed = True
+    fx_state["last_updated"] = last_updated
+    if changed:
+        fx_state["version"] += 1
+
+def price_matrix_stamp() -> tuple:
+    return snapshot_versions["next"], fx_state["version"]
+
+def build_price_matrix():
+    """Recomputes price_matrix[commodity, currency, unit column] for every cached commodity in one step."""
+    if price_matrix["unit_factors"] is None:
+        price_matrix["unit_factors"] = build_unit_factors()
+    usd = np.array([price_cache[name]["price"] if name in price_cache else np.nan for name in COMMODITIES], dtype=float)
+    rates = np.array([fx_rates.get(currency, np.nan) for currency in PRICE_CURRENCIES], dtype=float)
+    price_matrix["prices"] = np.round(usd[:, None, None] * rates[None, :, None] * price_matrix["unit_factors"][:, None, :], 6)
+    price_matrix["versions"] = [price_cache[name]["version"] if name in price_cache else None for name in COMMODITIES]
+    price_matrix["stamp"] = price_matrix_stamp()
+
+def quoted_price(name: str, snapshot: dict, currency: str = "USD", unit: Optional[str] = None) -> Optional[float]:
+    """The snapshot's price in currency per unit (None = the commodity's own unit), or None if not convertible."""
+    if currency == "USD" and unit is None:
+        return snapshot["price"]
+    if price_matrix["stamp"] != price_matrix_stamp(): # Snapshots or rates changed outside a refresh (e.g. shared-cache sync)
+        build_price_matrix()
+    row, column = COMMODITY_INDEX[name], UNIT_INDEX[unit] if unit else 0
+    if price_matrix["versions"][row] == snapshot["version"]:
+        value = price_matrix["prices"][row, CURRENCY_INDEX[currency], column]
+    else: # The caller holds an older snapshot than the table (a refresh landed mid-request); price that one
+        value = round(snapshot["price"] * fx_rates.get(currency, math.nan) * price_matrix["unit_factors"][row, column], 6)
+    return None if math.isnan(value) else float(value)
+
+def parse_price_quote(currency: str, unit: Optional[str], names: Iterable[str] = ()) -> tuple:
+    """Validates currency/unit query parameters; returns (currency, unit), unit None for each commodity's own.
+    Raises 400 for unknown values and 503 when the currency's FX rate isn't available yet."""
+    currency = currency.upper()
+    if currency not in PRICE_CURRENCIES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported currency '{currency}'. Supported: {', '.join(PRICE_CURRENCIES)}"
+        )
+    if currency not in fx_rates:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"No {currency} exchange rate available yet")
+    if unit:
+        unit = unit.strip().lower().replace(" ", "_").replace("-", "_")
+        unit = PRICE_UNIT_ALIASES.get(unit, unit)
+        if unit not in PRICE_UNITS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unsupported unit '{unit}'. Supported: {', '.join(PRICE_UNITS)}"
+            )
+        # Asking for a commodity's own unit is the default quote (same body, same ETag)
+        names = list(names)
+        if names and all(native_unit(name) == unit for name in names):
+            unit = None
+    return currency, unit or None
+
+
+# --- Pre-serialized Responses and Conditional GET ---
+# A price only changes when the refresher stores a new snapshot, so each snapshot's JSON body is rendered
+# to bytes once (eagerly at refresh for the common fresh case) with a strong ETag derived from the bytes.
+# Requests then just pick the cached bytes; clients and caches that send a matching If-None-Match get
+# a 304 with no body. Age and remaining freshness travel in the Age and Cache-Control headers.
+snapshot_versions = {"next": 1}
+
+def new_price_snapshot(name: str, price: float, last_updated: datetime, source: str) -> dict:
+    snapshot = {
+        "name": name, "price": price, "last_updated": last_updated, "source": source,
+        "version": snapshot_versions["next"], "rendered": {}
+    }
+    snapshot_versions["next"] += 1
+    # Render the variants every request path needs while we're off the request path
+    render_price_body(name, snapshot, f"{name}_price", stale=False)
+    render_price_body(name, snapshot, "price", stale=False)
+    return snapshot
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+def render_price_body(
+    name: str, snapshot: dict, price_field: str, stale: bool, currency: str = "USD", unit: Optional[str] = None
+):
+    """Returns (body bytes, ETag) for a snapshot, rendering and memoizing each variant the first time it's needed."""
+    # Converted quotes also depend on the FX rates they were rendered with
+    variant = (price_field, stale) if currency == "USD" and unit is None else (price_field, stale, currency, unit, fx_state["version"])
+    rendered = snapshot["rendered"].get(variant)
+    if rendered is None:
+        payload = price_payload(name, snapshot, price_field, stale, currency, unit)
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        rendered = (body, make_etag(body))
+        snapshot["rendered"][variant] = rendered
+    return rendered
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/"x" matches "x"
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate == etag or candidate == "W/" + etag for candidate in candidates)
+
+def price_cache_headers(snapshots: List[dict], private: bool = False) -> dict:
+    """Age of the oldest snapshot, and how long the response may be reused before the next refresh is due."""
+    age = max(price_age_seconds(snapshot) for snapshot in snapshots)
+    now = time.time()
+    next_due = min(refresh_schedule.next_due(snapshot["name"], snapshot["last_updated"].timestamp(), now) for snapshot in snapshots)
+    max_age = max(0, int(next_due - now))
+    return {
+        "Age": str(int(age)),
+        "Cache-Control": f"{'private' if private else 'public'}, max-age={max_age}"
+    }
+
+def conditional_response(body: bytes, etag: str, if_none_match: Optional[str], headers: dict) -> Response:
+    headers = {**headers, "ETag": etag}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def passthrough_headers(response: Response) -> dict:
+    """Headers set on an injected Response (e.g. rate limits) that must be copied onto a returned Response."""
+    return {key: value for key, value in response.headers.items() if key.lower() != "content-length"}
+
+# One entry per requested symbol list, e.g. the dashboard's full list or a client's /prices?symbols=...
+PRICE_MAP_BODY_CACHE_MAX_ENTRIES = 256
+price_map_body_cache = LRUTTLCache(PRICE_MAP_BODY_CACHE_MAX_ENTRIES, ttl_seconds=3600)
+
+def render_price_map_body(names: List[str], snapshots: dict, currency: str = "USD", unit: Optional[str] = None):
+    """Assembles a {"prices": ..., "errors": ...} body for names from the per-metal pre-rendered bytes.
+    Memoized per name list and quote until any of its snapshots (or, for converted quotes, the FX rates) change."""
+    stale_flags = {name: price_is_stale(snapshot) for name, snapshot in snapshots.items()}
+    names_key = (tuple(names), currency, unit)
+    state = tuple((snapshots[name]["version"], stale_flags[name]) if name in snapshots else None for name in names)
+    if currency != "USD" or unit is not None:
+        state += (fx_state["version"],)
+    cached = price_map_body_cache.get(names_key)
+    if cached is None or cached[0] != state:
+        quotable = [
+            name for name in names
+            if name in snapshots and ((unit is None and currency == "USD") or quoted_price(name, snapshots[name], currency, unit) is not None)
+        ]
+        prices = b",".join(
+            json.dumps(name).encode() + b":" + render_price_body(name, snapshots[name], "price", stale_flags[name], currency, unit)[0]
+            for name in quotable
+        )
+        errors = {name: f"Unable to fetch {name} price" for name in names if name not in snapshots}
+        errors.update({name: f"{name} can't be quoted {PRICE_UNITS[unit][0]}" for name in names if name in snapshots and name not in quotable})
+        body = b'{"prices":{' + prices + b'},"errors":' + json.dumps(errors, separators=(",", ":")).encode() + b"}"
+        cached = (state, body, make_etag(body))
+        price_map_body_cache.put(names_key, cached)
+    return cached[1], cached[2]
+
+
+async def authenticate_api_key(api_key: str, response: Optional[Response] = None, symbols: Iterable[str] = ()) -> dict:
+    """Rate-limits, validates (from the in-process key cache when possible) and records usage of an API key.
+    Rate limit headers are added to response when one is given; symbols feed the per-symbol usage breakdown."""
+    # Keys we've seen before are throttled before any lookup
+    decision = rate_limiter.acquire(api_key)
+    if decision is not None:
+        enforce_rate_limit(decision)
+
+    key_record = await lookup_active_api_key(api_key)
+    if not key_record:
+        auth_failures_total.inc(("invalid_api_key",))
+        logger.warning("Rejected invalid or inactive API key", extra={"sample_every": 100, "fields": {"key": api_key[:8]}})
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API key")
+
+    if decision is None: # First request from this key since startup: create its bucket for the key's plan
+        decision = rate_limiter.acquire(api_key, plan=key_record["plan"])
+        enforce_rate_limit(decision)
+    if response is not None:
+        response.headers.update(rate_limit_headers(decision))
+
+    # Log key usage (write-behind, no DB round-trip here)
+    usage_accumulator.record(api_key, symbols, user_id=key_record["user_id"])
+    return key_record
+
+def resolve_commodity(symbol: str) -> str:
+    """Maps a commodity name ("gold") or ticker ("GC=F") to its registry name, or raises 404."""
+    name = symbol.lower() if symbol.lower() in COMMODITIES else SYMBOL_TO_COMMODITY.get(symbol.upper())
+    if name is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown symbol '{symbol}'")
+    return name
+
+def parse_symbol_filter(symbols: Optional[str]) -> List[str]:
+    """Resolves a comma-separated symbol list (names or tickers) to unique registry names, defaulting to all."""
+    if not symbols:
+        return list(COMMODITIES)
+    return list(dict.fromkeys(resolve_commodity(symbol.strip()) for symbol in symbols.split(",") if symbol.strip()))
+
+
+# --- Commodity Price Endpoints (Use API Key Auth) ---
+# One GET /<name> endpoint is registered per registry entry (/gold, /silver, /palladium, ...).
+
+def make_commodity_endpoint(name: str):
+    async def get_commodity_data(
+        response: Response,
+        currency: str = "USD",
+        unit: Optional[str] = None,
+        api_key: str = Header(...),
+        if_none_match: Optional[str] = Header(None)
+    ):
+        try:
+            # Validate the quote before charging the key for it
+            currency, unit = parse_price_quote(currency, unit, [name])
+            if unit is not None and native_unit(name) is None:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{name} can't be quoted {PRICE_UNITS[unit][0]}")
+
+            await authenticate_api_key(api_key, response, symbols=(name,))
+
+            # Serve the pre-rendered snapshot kept fresh by the background refresher
+            snapshot = (await get_price_snapshots([name])).get(name)
+            if snapshot is None:
+                raise HTTPException(status_code=503, detail=f"Unable to fetch {name} price")
+
+            body, etag = render_price_body(name, snapshot, f"{name}_price", price_is_stale(snapshot), currency, unit)
+            headers = {
+                **passthrough_headers(response),
+                **price_cache_headers([snapshot]),
+                "Vary": "api-key" # Shared caches must keep one copy per key
+            }
+            return conditional_response(body, etag, if_none_match, headers)
+        except HTTPException as http_exc: # Re-raise HTTP exceptions
+            raise http_exc
+        except Exception as e:
+            logger.exception("Unexpected error in get_%s_data", name, extra={"fields": {"key": api_key[:8]}}) # Avoid logging full key
+            raise HTTPException(status_code=500, detail=f"An unexpected error occurred while fetching {name} data.")
+
+    get_commodity_data.__name__ = f"get_{name}_data"
+    return get_commodity_data
+
+for commodity_name in COMMODITIES:
+    app.add_api_route(f"/{commodity_name}", make_commodity_endpoint(commodity_name), methods=["GET"])
+
+@app.get("/prices")
+async def get_prices(
+    response: Response,
+    symbols: Optional[str] = None,
+    currency: str = "USD",
+    unit: Optional[str] = None,
+    api_key: str = Header(...),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Returns several commodity prices in one response (symbols=gold,silver,palladium, default all).
+    Counts as a single request for rate limiting and usage, with a per-symbol usage breakdown."""
+    try:
+        # Validate the query before charging the key for it
+        names = parse_symbol_filter(symbols)
+        if not names:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="At least one symbol is required")
+        currency, unit = parse_price_quote(currency, unit, names)
+
+        await authenticate_api_key(api_key, response, symbols=names)
+
+        snapshots = await get_price_snapshots(names)
+        if not snapshots:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Unable to fetch any of the requested prices")
+
+        body, etag = render_price_map_body(names, snapshots, currency, unit)
+        headers = {
+            **passthrough_headers(response),
+            **price_cache_headers(list(snapshots.values())),
+            "Vary": "api-key"
+        }
+        return conditional_response(body, etag, if_none_match, headers)
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
+        raise http_exc
     except Exception as e:
-        print(f"Error fetching palladium for dashboard: {e}")
-        errors["palladium"] = "Error fetching palladium price"
-
-    # Return fetched prices and any errors encountered
-    # If no prices could be fetched at all, maybe return a 503?
-    if not prices and errors:
-         # Raise a 503 if all fetches failed
-         first_error = list(errors.values())[0]
-         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Failed to fetch any prices. Last error: {first_error}")
-
-    return {"prices": prices, "errors": errors}
-
-
-# --- Silver Price Endpoint (Uses API Key Auth) ---
-@app.get("/silver")
-async def get_silver_data(api_key: str = Header(...)):
-    conn = None
+        logger.exception("Unexpected error in get_prices", extra={"fields": {"key": api_key[:8]}}) # Avoid logging full key
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching prices.")
+
+
+@app.get("/commodities")
+async def list_commodities():
+    """Lists the instruments served by the API and the endpoint for each."""
+    return {
+        name: {"symbol": spec["symbol"], "unit": spec["unit"], "endpoint": f"/{name}"}
+        for name, spec in COMMODITIES.items()
+    }
+
+
+# --- Price History Endpoint (Uses API Key Auth) ---
+@app.get("/history/{symbol}")
+async def get_price_history(
+    symbol: str,
+    response: Response,
+    resolution: str = "1h",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    limit: int = 500,
+    api_key: str = Header(...)
+):
+    """Returns OHLC bars for a commodity (name or ticker) between start and end (Unix timestamps), newest limit bars."""
     try:
-        global silver_price_cache, silver_price_last_updated
-
-        # Validate API key
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM api_keys WHERE key = ? AND is_active = 1", (api_key,))
-        key_record = cursor.fetchone()
-
-        if not key_record:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API key")
-
-        # Log key usage
-        await log_key_usage(api_key)
-
-        # Check cache
-        if (silver_price_last_updated is None or
-            (datetime.now() - silver_price_last_updated) > timedelta(minutes=1)):
-            silver_price = await fetch_live_silver_price()
-            if silver_price is not None:
-                silver_price_cache = silver_price
-                silver_price_last_updated = datetime.now()
-
-        if silver_price_cache is None:
-            raise HTTPException(status_code=503, detail="Unable to fetch silver price")
-
+        # Validate the query before charging the key for it
+        name = resolve_commodity(symbol)
+        if resolution not in HISTORY_RESOLUTIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported resolution '{resolution}'. Use one of: {', '.join(HISTORY_RESOLUTIONS)}"
+            )
+        if not 1 <= limit <= HISTORY_MAX_BARS:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_MAX_BARS}")
+
+        await authenticate_api_key(api_key, response)
+
+        ticker = COMMODITIES[name]["symbol"]
+        rows = await db_fetch_all(
+            '''
+            SELECT bucket_start, open, high, low, close, tick_count FROM price_bars
+            WHERE symbol = ? AND resolution = ? AND bucket_start >= ? AND bucket_start <= ?
+            ORDER BY bucket_start DESC LIMIT ?
+            ''',
+            (ticker, resolution, start if start is not None else 0, end if end is not None else time.time(), limit)
+        )
+        bars = [
+            {
+                "time": row["bucket_start"],
+                "open": row["open"],
+                "high": row["high"],
+                "low": row["low"],
+                "close": row["close"],
+                "ticks": row["tick_count"]
+            }
+            for row in reversed(rows)
+        ]
         return {
-            "silver_price": silver_price_cache,
+            "symbol": ticker,
+            "name": name,
+            "resolution": resolution,
             "currency": "USD",
-            "last_updated": silver_price_last_updated.timestamp(),
-            "unit": "per troy ounce",
-            "source": "live market data"
+            "unit": COMMODITIES[name]["unit"],
+            "bars": bars
         }
-    except HTTPException as http_exc:
-        raise http_exc
-    except HTTPException as http_exc:
-        raise http_exc
-    except HTTPException as http_exc:
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
         raise http_exc
     except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in get_silver_data for key {api_key[:8]}... !!!")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching silver data.")
-    finally:
-        if conn:
-            conn.close()
-
+        logger.exception("Unexpected error in get_price_history", extra={"fields": {"symbol": symbol, "key": api_key[:8]}})
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching price history.")
+
+
+# --- Price Analytics (Uses API Key Auth) ---
+# Indicators are computed with vectorized NumPy/pandas operations over the close prices of the OHLC
+# rollups. Results are memoized per (symbol, resolution, window, limit) and reused until new history
+# is stored for any symbol they depend on.
+ANALYTICS_MAX_WINDOW = 500
+analytics_cache = LRUTTLCache(max_entries=256, ttl_seconds=3600)
+
+async def load_close_series(ticker: str, resolution: str, limit: int) -> "pd.Series":
+    """Returns the newest `limit` bar closes for ticker as a float Series indexed by bucket start."""
+    def load(conn):
+        rows = conn.execute(
+            "SELECT bucket_start, close FROM price_bars WHERE symbol = ? AND resolution = ? ORDER BY bucket_start DESC LIMIT ?",
+            (ticker, resolution, limit)
+        ).fetchall()
+        values = np.array([(row["bucket_start"], row["close"]) for row in rows], dtype=float).reshape(-1, 2)[::-1]
+        return pd.Series(values[:, 1], index=values[:, 0])
+    return await run_db(load)
+
+def _json_floats(values) -> list:
+    """Converts an array to a JSON-friendly list, with NaN (e.g. before a window fills) as null."""
+    array = np.asarray(values, dtype=float)
+    return [None if np.isnan(value) else round(float(value), 6) for value in array]
+
+def compute_price_analytics(closes: "pd.Series", window: int) -> dict:
+    log_returns = np.log(closes).diff()
+    sma = closes.rolling(window).mean()
+    ema = closes.ewm(span=window, adjust=False).mean()
+    volatility = log_returns.rolling(window).std()
+    running_max = np.maximum.accumulate(closes.to_numpy())
+    drawdown = closes.to_numpy() / running_max - 1.0
+    return {
+        "points": int(len(closes)),
+        "summary": {
+            "last": float(closes.iloc[-1]),
+            "min": float(closes.min()),
+            "max": float(closes.max()),
+            "max_drawdown": float(drawdown.min()),
+            "mean_log_return": _json_floats([log_returns.mean()])[0],
+            "volatility": _json_floats([volatility.iloc[-1]])[0]
+        },
+        "series": {
+            "time": closes.index.tolist(),
+            "close": _json_floats(closes),
+            "sma": _json_floats(sma),
+            "ema": _json_floats(ema),
+            "log_return": _json_floats(log_returns),
+            "volatility": _json_floats(volatility),
+            "drawdown": _json_floats(drawdown)
+        }
+    }
 
-# --- Palladium Price Endpoint (Uses API Key Auth) ---
-@app.get("/palladium")
-async def get_palladium_data(api_key: str = Header(...)):
-    conn = None
+def compute_ratio(numerator: "pd.Series", denominator: "pd.Series", window: int) -> Optional[dict]:
+    """Ratio of two close series over the buckets both have, e.g. the gold/silver ratio."""
+    aligned = pd.concat([numerator, denominator], axis=1, join="inner").dropna()
+    if aligned.empty:
+        return None
+    ratio = aligned.iloc[:, 0] / aligned.iloc[:, 1]
+    return {
+        "last": float(ratio.iloc[-1]),
+        "mean": float(ratio.tail(window).mean()),
+        "min": float(ratio.min()),
+        "max": float(ratio.max()),
+        "series": {"time": ratio.index.tolist(), "ratio": _json_floats(ratio)}
+    }
+
+@app.get("/analytics/{symbol}")
+async def get_price_analytics(
+    symbol: str,
+    response: Response,
+    resolution: str = "1d",
+    window: int = 20,
+    limit: int = 500,
+    api_key: str = Header(...)
+):
+    """Moving averages, log returns, rolling volatility, drawdown and the gold/silver ratio for a commodity."""
     try:
-        global palladium_price_cache, palladium_price_last_updated
+        # Validate the query before charging the key for it
+        name = resolve_commodity(symbol)
+        if resolution not in HISTORY_RESOLUTIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported resolution '{resolution}'. Use one of: {', '.join(HISTORY_RESOLUTIONS)}"
+            )
+        if not 1 <= limit <= HISTORY_MAX_BARS:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_MAX_BARS}")
+        if not 2 <= window <= min(limit, ANALYTICS_MAX_WINDOW):
+            raise HTTPException(status_code=400, detail=f"window must be between 2 and {min(limit, ANALYTICS_MAX_WINDOW)}")
+
+        await authenticate_api_key(api_key, response)
+
+        ticker = COMMODITIES[name]["symbol"]
+        ratio_tickers = (COMMODITIES["gold"]["symbol"], COMMODITIES["silver"]["symbol"])
+        # Read from the database, so followers and offline backfills invalidate the memo as well
+        versions = await load_history_versions((ticker,) + ratio_tickers)
+        cache_key = (ticker, resolution, window, limit)
+        cached = analytics_cache.get(cache_key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        closes = await load_close_series(ticker, resolution, limit)
+        if closes.empty:
+            raise HTTPException(status_code=404, detail=f"No {resolution} history stored for {name} yet")
+
+        gold_closes = closes if ticker == ratio_tickers[0] else await load_close_series(ratio_tickers[0], resolution, limit)
+        silver_closes = closes if ticker == ratio_tickers[1] else await load_close_series(ratio_tickers[1], resolution, limit)
+        # Thousands of bars over a wide window take a while to crunch; do it off the event loop
+        analytics, ratio = await run_blocking(
+            lambda: (compute_price_analytics(closes, window), compute_ratio(gold_closes, silver_closes, window))
+        )
+        result = {
+            "symbol": ticker,
+            "name": name,
+            "resolution": resolution,
+            "window": window,
+            **analytics,
+            "gold_silver_ratio": ratio
+        }
 
-        # Validate API key
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM api_keys WHERE key = ? AND is_active = 1", (api_key,))
-        key_record = cursor.fetchone()
+        analytics_cache.put(cache_key, (versions, result))
+        return result
+    except HTTPException as http_exc: # Re-raise HTTP exceptions
+        raise http_exc
+    except Exception as e:
+        logger.exception("Unexpected error in get_price_analytics", extra={"fields": {"symbol": symbol, "key": api_key[:8]}})
+        raise HTTPException(status_code=500, detail="An unexpected error occurred while computing analytics.")
+
+
+# --- Price Streaming Endpoints (API Key or JWT Auth, checked once at connect) ---
+# Clients hold one connection open instead of polling: they get the current snapshot on connect,
+# then one event per price change. Browsers' EventSource can't set headers, so both endpoints also
+# accept the credentials as query parameters.
+
+async def authenticate_stream(api_key: Optional[str], token: Optional[str], authorization: Optional[str]):
+    if api_key:
+        await authenticate_api_key(api_key)
+        return
+    if not token and authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if token:
+        await get_current_user(token)
+        return
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="An api-key or bearer token is required")
+
+async def subscribe_with_snapshot(names: List[str]):
+    """Subscribes first (so no change is missed), then returns the queue and the current snapshot messages.
+    If the snapshot fails (e.g. a 503 on a cold cache) the subscription is dropped before the error propagates."""
+    subscriber = price_broadcaster.subscribe()
+    try:
+        snapshots = await get_price_snapshots(names)
+        return subscriber, [json.dumps(price_event(name, snapshot)) for name, snapshot in snapshots.items()]
+    except BaseException:
+        price_broadcaster.unsubscribe(subscriber)
+        raise
+
+@app.get("/stream/prices")
+async def stream_prices_sse(
+    symbols: Optional[str] = None,
+    token: Optional[str] = None,
+    api_key: Optional[str] = Header(None),
+    api_key_param: Optional[str] = Query(None, alias="api_key"),
+    authorization: Optional[str] = Header(None)
+):
+    """Server-Sent Events stream of price changes."""
+    await authenticate_stream(api_key or api_key_param, token, authorization)
+    names = set(parse_symbol_filter(symbols))
+    subscriber, initial_messages = await subscribe_with_snapshot(list(names))
+
+    async def event_stream():
+        try:
+            for message in initial_messages:
+                yield f"event: price\ndata: {message}\n\n"
+            while True:
+                try:
+                    name, message = await asyncio.wait_for(subscriber.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n" # Comment line keeps proxies from closing an idle stream
+                    continue
+                if name in names:
+                    yield f"event: price\ndata: {message}\n\n"
+        finally:
+            price_broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        if not key_record:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or inactive API key")
+@app.websocket("/ws/prices")
+async def stream_prices_ws(
+    websocket: WebSocket,
+    symbols: Optional[str] = None,
+    token: Optional[str] = None,
+    api_key: Optional[str] = None
+):
+    """WebSocket stream of price changes (same JSON events as /stream/prices)."""
+    try:
+        await authenticate_stream(api_key or websocket.headers.get("api-key"), token, websocket.headers.get("authorization"))
+        names = set(parse_symbol_filter(symbols))
+    except HTTPException as http_exc:
+        await websocket.close(code=1008, reason=str(http_exc.detail)) # 1008: policy violation
+        return
 
-        # Log key usage
-        await log_key_usage(api_key)
+    await websocket.accept()
+    subscriber, initial_messages = await subscribe_with_snapshot(list(names))
+    try:
+        for message in initial_messages:
+            await websocket.send_text(message)
+        while True:
+            try:
+                name, message = await asyncio.wait_for(subscriber.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                await websocket.send_text(json.dumps({"type": "keepalive"}))
+                continue
+            if name in names:
+                await websocket.send_text(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        price_broadcaster.unsubscribe(subscriber)
 
-        # Check cache
-        if (palladium_price_last_updated is None or
-            (datetime.now() - palladium_price_last_updated) > timedelta(minutes=1)):
-            palladium_price = await fetch_live_palladium_price()
-            if palladium_price is not None:
-                palladium_price_cache = palladium_price
-                palladium_price_last_updated = datetime.now()
 
-        if palladium_price_cache is None:
-            raise HTTPException(status_code=503, detail="Unable to fetch palladium price")
+# --- Dashboard Prices Endpoint (Uses JWT Auth) ---
+@app.get("/dashboard/prices")
+async def get_dashboard_prices(
+    currency: str = "USD",
+    unit: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Returns all commodity prices for the authenticated dashboard user."""
+    currency, unit = parse_price_quote(currency, unit, COMMODITIES)
+    # No API key validation or usage logging needed here, as auth is handled by JWT.
+    # Prices come straight from the snapshot maintained by the background refresher.
+    snapshots = await get_price_snapshots(list(COMMODITIES))
 
-        return {
-            "palladium_price": palladium_price_cache,
-            "currency": "USD",
-            "last_updated": palladium_price_last_updated.timestamp(),
-            "unit": "per troy ounce",
-            "source": "live market data"
-        }
-    except HTTPException as http_exc:
-        raise http_exc
-    except HTTPException as http_exc:
-        raise http_exc
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as e:
-        print(f"!!! UNEXPECTED ERROR in get_palladium_data for key {api_key[:8]}... !!!")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail="An unexpected error occurred while fetching palladium data.")
-    finally:
-        if conn:
-            conn.close()
+    # Return fetched prices and any errors encountered
+    if not snapshots:
+         # Raise a 503 if all fetches failed
+         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Failed to fetch any prices. Last error: Unable to fetch {next(iter(COMMODITIES))} price")
+
+    body, etag = render_price_map_body(list(COMMODITIES), snapshots, currency, unit)
+    return conditional_response(body, etag, if_none_match, price_cache_headers(list(snapshots.values()), private=True))
+
+
+# --- Operational Stats (Uses JWT Auth) ---
+@app.get("/system/stats")
+async def get_system_stats(current_user: dict = Depends(get_current_user)):
+    """Exposes internal counters, e.g. how many upstream fetches were shared between concurrent callers."""
+    return {
+        "price_refresher": {"refresh_in_progress": price_refresh_in_progress, "schedule": refresh_schedule.stats()},
+        "price_fetches": price_fetches.stats(),
+        "shared_price_cache": shared_price_cache.stats() if shared_price_cache is not None else None,
+        "upstream": {**upstream_fetch_stats, "providers": {provider.name: provider.stats() for provider in price_providers}},
+        "api_key_cache": api_key_cache.stats(),
+        "rejected_api_key_cache": rejected_api_key_cache.stats(),
+        "usage_accounting": usage_accumulator.stats(),
+        "db_pool": db_pool.stats(),
+        "analytics_cache": analytics_cache.stats(),
+        "price_stream": price_broadcaster.stats(),
+        "price_map_bodies": price_map_body_cache.stats(),
+        "fx": {**fx_state, "rates": fx_rates},
+        "rate_limiter": rate_limiter.stats(),
+        "principal_cache": principal_cache.stats(),
+        "password_hashing": password_hasher.stats()
+    }
+
+
+@app.get("/metrics")
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint. Open unless METRICS_TOKEN is set."""
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Registered last so it runs after every other shutdown hook that may still need the database (e.g. the usage flush)
+@app.on_event("shutdown")
+def close_database():
+    db_pool.close_all()
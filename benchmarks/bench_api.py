@@ -0,0 +1,132 @@
+"""
+Load test for the main API endpoints.
+
+The app runs in-process (httpx ASGI transport) against a temporary SQLite database and the offline
+price provider, so results measure the server code, not the network or Yahoo. Each scenario is run
+by --concurrency closed-loop clients until --requests responses have been received, and reports
+throughput and p50/p95/p99 latency.
+
+Scenarios:
+  gold            GET /gold (API key)
+  prices          GET /prices?symbols=gold,silver,palladium (API key)
+  dashboard       GET /dashboard/prices (JWT)
+  login           POST /login (bcrypt; uses --login-requests)
+  api_keys_crud   POST /api-keys, GET /api-keys, POST /api-keys/{key}/toggle, DELETE /api-keys/{key},
+                  each reported separately
+  log             POST /api-keys/{key}/log
+
+Requires httpx (pip install httpx).
+
+Usage:
+    python benchmarks/bench_api.py [--requests 2000] [--concurrency 32] [--login-requests 50]
+                                   [--scenarios gold,dashboard] [--json results.json]
+"""
+import argparse
+import asyncio
+import time
+
+import harness
+
+import httpx
+
+import api  # noqa: E402  (after harness, which points it at a temp DB and the offline provider)
+
+SCENARIOS = ("gold", "prices", "dashboard", "login", "api_keys_crud", "log")
+USERNAME = "bench"
+PASSWORD = "bench-password"
+
+
+async def run_load(total, concurrency, request):
+    """Runs request(i) total times from `concurrency` concurrent clients. request returns
+    {name: latency_ms} (several entries when one iteration covers several calls)."""
+    latencies = {}
+    counter = iter(range(total))
+
+    async def client_loop():
+        for i in counter:
+            for name, latency in (await request(i)).items():
+                latencies.setdefault(name, []).append(latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {name: harness.summarize_latencies(samples, elapsed) for name, samples in latencies.items()}
+
+
+async def timed(call, expected_status=200):
+    started = time.perf_counter()
+    response = await call
+    latency = (time.perf_counter() - started) * 1000
+    assert response.status_code == expected_status, f"{response.status_code}: {response.text}"
+    return latency, response
+
+
+async def run_scenario(name, client, args, api_key, auth_headers):
+    if name == "gold":
+        async def request(i):
+            return {"gold": (await timed(client.get("/gold", headers={"api-key": api_key})))[0]}
+    elif name == "prices":
+        async def request(i):
+            call = client.get("/prices", params={"symbols": "gold,silver,palladium"}, headers={"api-key": api_key})
+            return {"prices": (await timed(call))[0]}
+    elif name == "dashboard":
+        async def request(i):
+            return {"dashboard": (await timed(client.get("/dashboard/prices", headers=auth_headers)))[0]}
+    elif name == "login":
+        async def request(i):
+            return {"login": (await timed(client.post("/login", data={"username": USERNAME, "password": PASSWORD})))[0]}
+        return await run_load(args.login_requests, args.concurrency, request)
+    elif name == "api_keys_crud":
+        async def request(i):
+            create_ms, response = await timed(client.post("/api-keys", headers=auth_headers))
+            key = response.json()["key"]
+            list_ms, _ = await timed(client.get("/api-keys", headers=auth_headers))
+            toggle_ms, _ = await timed(client.post(f"/api-keys/{key}/toggle", headers=auth_headers))
+            delete_ms, _ = await timed(client.delete(f"/api-keys/{key}", headers=auth_headers))
+            return {"api_keys_create": create_ms, "api_keys_list": list_ms, "api_keys_toggle": toggle_ms, "api_keys_delete": delete_ms}
+        # Four calls per iteration, so the same number of HTTP requests as the other scenarios
+        return await run_load(max(1, args.requests // 4), args.concurrency, request)
+    elif name == "log":
+        async def request(i):
+            return {"log": (await timed(client.post(f"/api-keys/{api_key}/log")))[0]}
+    return await run_load(args.requests, args.concurrency, request)
+
+
+async def main(args):
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    api.PLAN_RATE_LIMITS["free"]["limit"] = 10 ** 9
+
+    results = {}
+    async with api.app.router.lifespan_context(api.app):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/register", json={"username": USERNAME, "password": PASSWORD})
+            token = (await client.post("/login", data={"username": USERNAME, "password": PASSWORD})).json()["access_token"]
+            auth_headers = {"Authorization": f"Bearer {token}"}
+            api_key = (await client.post("/api-keys", headers=auth_headers)).json()["key"]
+            await client.get("/gold", headers={"api-key": api_key}) # Warm the price cache
+
+            for name in scenarios:
+                scenario_results = await run_scenario(name, client, args, api_key, auth_headers)
+                results.update(scenario_results)
+                for result_name, summary in scenario_results.items():
+                    print(
+                        f"{result_name:<16} {summary['requests']:>6} req  {summary['throughput_rps']:>9.1f} req/s  "
+                        f"p50 {summary['p50_ms']:8.2f} ms  p95 {summary['p95_ms']:8.2f} ms  p99 {summary['p99_ms']:8.2f} ms"
+                    )
+
+    if args.json:
+        harness.write_results(args.json, "api", args, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--login-requests", type=int, default=50, help="requests for the (bcrypt-bound) login scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,115 @@
+"""
+Compares the old per-request SQLite access pattern with the pooled WAL data layer in api.py.
+
+Each simulated request does what a price endpoint used to do on every call: validate the API key
+(SELECT) and record its usage (UPDATE + commit).
+
+  before: a fresh sqlite3.connect() per statement, default rollback journal, run inline on the event loop
+  after:  api.run_db / api.db_execute on pooled WAL connections, run on the bounded DB executor
+
+Usage:
+    python benchmarks/bench_db.py [--requests 2000] [--concurrency 32] [--keys 100]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix="goldprice-bench-db-")
+os.environ["API_KEYS_DB_PATH"] = os.path.join(WORK_DIR, "pooled.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import api  # noqa: E402
+
+LEGACY_DB_PATH = os.path.join(WORK_DIR, "legacy.db")
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS api_keys (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        is_active BOOLEAN DEFAULT 1,
+        created_at REAL,
+        last_used REAL,
+        usage_count INTEGER DEFAULT 0,
+        user_id INTEGER
+    )
+"""
+
+
+def seed(path, keys):
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+    conn.executemany(
+        "INSERT INTO api_keys (key, is_active, created_at, last_used, usage_count, user_id) VALUES (?, 1, ?, 0, 0, 1)",
+        [(key, time.time()) for key in keys]
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_connection():
+    conn = sqlite3.connect(LEGACY_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+async def legacy_request(key):
+    conn = legacy_connection()
+    try:
+        conn.execute("SELECT id FROM api_keys WHERE key = ? AND is_active = 1", (key,)).fetchone()
+    finally:
+        conn.close()
+    conn = legacy_connection()
+    try:
+        conn.execute("UPDATE api_keys SET last_used = ?, usage_count = usage_count + 1 WHERE key = ?", (time.time(), key))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def pooled_request(key):
+    await api.db_fetch_one("SELECT id FROM api_keys WHERE key = ? AND is_active = 1", (key,))
+    await api.db_execute("UPDATE api_keys SET last_used = ?, usage_count = usage_count + 1 WHERE key = ?", (time.time(), key))
+
+
+async def run(request, keys, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await request(random.choice(keys))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def main(args):
+    keys = [f"bench-key-{i}" for i in range(args.keys)]
+    seed(LEGACY_DB_PATH, keys)
+    api.init_db()
+    with api.db_pool.connection() as conn:
+        with conn:
+            conn.executemany(
+                "INSERT INTO api_keys (key, is_active, created_at, last_used, usage_count, user_id) VALUES (?, 1, ?, 0, 0, 1)",
+                [(key, time.time()) for key in keys]
+            )
+
+    before = await run(legacy_request, keys, args.requests, args.concurrency)
+    after = await run(pooled_request, keys, args.requests, args.concurrency)
+    print(f"requests={args.requests} concurrency={args.concurrency} keys={args.keys}")
+    print(f"before (connect per query, rollback journal): {before:10.1f} req/s")
+    print(f"after  (pooled WAL connections, DB executor): {after:10.1f} req/s")
+    print(f"speedup: {after / before:.2f}x")
+    api.db_pool.close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--keys", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
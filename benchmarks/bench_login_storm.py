@@ -0,0 +1,109 @@
+"""
+Measures /gold latency while a storm of concurrent /login requests is running.
+
+The app runs in-process (httpx ASGI transport, temporary database, stubbed yfinance) so the numbers
+reflect the server's event loop only. Two scenarios are measured:
+
+  inline:  bcrypt runs directly on the event loop (how /login and /register used to behave)
+  pooled:  bcrypt runs on api.password_hasher's bounded worker pool
+
+Requires httpx (pip install httpx).
+
+Usage:
+    python benchmarks/bench_login_storm.py [--logins 40] [--login-concurrency 20] [--gold-requests 100]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ["API_KEYS_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="goldprice-bench-login-"), "api_keys.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import api  # noqa: E402
+
+
+def fake_download(symbols, **kwargs):
+    columns = pd.MultiIndex.from_product([["Close"], symbols])
+    return pd.DataFrame([[2000.0 + i for i in range(len(symbols))]], columns=columns)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def measure_gold(client, api_key, requests=None, until=None, interval=0.01):
+    """Issues /gold on a fixed schedule and measures each latency from its scheduled start, so time the
+    event loop spends blocked before a request could even be sent is counted (no coordinated omission)."""
+    latencies = []
+    loop = asyncio.get_running_loop()
+    scheduled = loop.time()
+    while (requests is not None and len(latencies) < requests) or (until is not None and not until.done()):
+        await asyncio.sleep(max(0.0, scheduled - loop.time()))
+        response = await client.get("/gold", headers={"api-key": api_key})
+        latencies.append((loop.time() - scheduled) * 1000)
+        assert response.status_code == 200, response.text
+        scheduled += interval
+    return latencies
+
+
+async def login_storm(client, logins, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            await client.post("/login", data={"username": "bench", "password": "bench-password"})
+
+    await asyncio.gather(*(login() for _ in range(logins)))
+
+
+async def scenario(client, api_key, args):
+    baseline = await measure_gold(client, api_key, args.gold_requests)
+    started = time.perf_counter()
+    storm = asyncio.create_task(login_storm(client, args.logins, args.login_concurrency))
+    during = await measure_gold(client, api_key, until=storm)
+    await storm
+    return baseline, during, time.perf_counter() - started
+
+
+def report(label, baseline, during, elapsed, logins):
+    print(f"{label:<7} /gold p50 {statistics.median(baseline):7.2f} ms -> {statistics.median(during):7.2f} ms during storm, "
+          f"p95 {percentile(baseline, 95):7.2f} ms -> {percentile(during, 95):7.2f} ms, "
+          f"max {max(during):8.2f} ms  ({logins} logins in {elapsed:.2f}s)")
+
+
+async def main(args):
+    api.yf.download = fake_download
+    api.PLAN_RATE_LIMITS["free"]["limit"] = 10 ** 9
+    async with api.app.router.lifespan_context(api.app):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/register", json={"username": "bench", "password": "bench-password"})
+            token = (await client.post("/login", data={"username": "bench", "password": "bench-password"})).json()["access_token"]
+            api_key = (await client.post("/api-keys", headers={"Authorization": f"Bearer {token}"})).json()["key"]
+
+            pooled_hasher = api.password_hasher
+            inline_hasher = type("InlineHasher", (), {
+                "hash": staticmethod(lambda password: asyncio.sleep(0, api.get_password_hash(password))),
+                "verify": staticmethod(lambda plain, hashed: asyncio.sleep(0, api.verify_password(plain, hashed))),
+            })
+            api.password_hasher = inline_hasher
+            report("inline", *await scenario(client, api_key, args), args.logins)
+            api.password_hasher = pooled_hasher
+            report("pooled", *await scenario(client, api_key, args), args.logins)
+            print(f"hash pool: {api.password_hasher.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--login-concurrency", type=int, default=20)
+    parser.add_argument("--gold-requests", type=int, default=100, help="baseline /gold samples before the storm")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,126 @@
+"""
+Micro-benchmarks of the per-request building blocks in api.py.
+
+Each case runs --iterations times per repeat; the best of --repeat runs is reported as ns/op, which
+filters out scheduler and GC noise. Runs against a temporary database and the offline price provider.
+
+Cases:
+  key_validation_cached      lookup_active_api_key, in-process cache hit
+  key_validation_db          lookup_active_api_key, cache invalidated first (pooled DB round-trip)
+  authenticate_api_key       rate limit + cached lookup + usage record, as done by every price request
+  rate_limit_acquire         RateLimiter.acquire for a known key
+  usage_record               UsageAccumulator.record with a one-symbol breakdown
+  usage_flush_100_keys       one batched flush of usage for 100 distinct keys
+  serialize_price_cached     render_price_body for an already rendered snapshot
+  serialize_price_uncached   json.dumps of price_payload (what every request did before pre-rendering)
+  serialize_price_map_cached render_price_map_body for all commodities, memoized
+  serialize_price_map        render_price_map_body for all commodities after clearing the memo
+  serialize_price_converted  render_price_body for gold in EUR per gram, memoized (a price-matrix lookup when new)
+  price_matrix_build         one vectorized rebuild of the commodities x currencies x units price table
+  metrics_counter_inc        one labelled Counter.inc (what each instrumented event costs)
+  metrics_histogram_observe  one labelled Histogram.observe
+  metrics_render             a full /metrics exposition
+
+Usage:
+    python benchmarks/bench_micro.py [--iterations 20000] [--repeat 5] [--cases usage_record,...] [--json results.json]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import harness
+
+import api  # noqa: E402  (after harness, which points it at a temp DB and the offline provider)
+
+
+async def measure(func, iterations, repeat, is_async):
+    """Best-of-repeat nanoseconds per call of func()."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        if is_async:
+            for _ in range(iterations):
+                await func()
+        else:
+            for _ in range(iterations):
+                func()
+        per_op = (time.perf_counter_ns() - started) / iterations
+        best = per_op if best is None else min(best, per_op)
+    return best
+
+
+def build_cases(api_key, names, snapshots):
+    gold = snapshots["gold"]
+    flush_keys = [f"bench-flush-{i}" for i in range(100)]
+
+    async def key_validation_db():
+        api.api_key_cache.invalidate(api_key)
+        await api.lookup_active_api_key(api_key)
+
+    async def usage_flush_100_keys():
+        for key in flush_keys:
+            api.usage_accumulator.record(key, ("gold",))
+        await api.usage_accumulator.flush()
+
+    def serialize_price_map():
+        api.price_map_body_cache.clear()
+        api.render_price_map_body(names, snapshots)
+
+    # name -> (callable, is_async, iteration divisor for slow cases)
+    return {
+        "key_validation_cached": (lambda: api.lookup_active_api_key(api_key), True, 1),
+        "key_validation_db": (key_validation_db, True, 20),
+        "authenticate_api_key": (lambda: api.authenticate_api_key(api_key), True, 1),
+        "rate_limit_acquire": (lambda: api.rate_limiter.acquire(api_key), False, 1),
+        "usage_record": (lambda: api.usage_accumulator.record(api_key, ("gold",)), False, 1),
+        "usage_flush_100_keys": (usage_flush_100_keys, True, 200),
+        "serialize_price_cached": (lambda: api.render_price_body("gold", gold, "gold_price", False), False, 1),
+        "serialize_price_uncached": (
+            lambda: json.dumps(api.price_payload("gold", gold, "gold_price", False), separators=(",", ":")).encode(), False, 1
+        ),
+        "serialize_price_map_cached": (lambda: api.render_price_map_body(names, snapshots), False, 1),
+        "serialize_price_map": (serialize_price_map, False, 1),
+        "serialize_price_converted": (lambda: api.render_price_body("gold", gold, "gold_price", False, "EUR", "gram"), False, 1),
+        "price_matrix_build": (api.build_price_matrix, False, 10),
+        "metrics_counter_inc": (lambda: api.auth_failures_total.inc(("bench",)), False, 1),
+        "metrics_histogram_observe": (
+            lambda: api.http_request_duration_seconds.observe(0.0012, ("GET", "/bench")), False, 1
+        ),
+        "metrics_render": (api.render_metrics, False, 100),
+    }
+
+
+async def main(args):
+    api.PLAN_RATE_LIMITS["free"]["limit"] = 10 ** 9
+    results = {}
+    async with api.app.router.lifespan_context(api.app):
+        user_id = (await api.register_user(api.UserCreate(username="bench", password="bench-password")))["id"]
+        api_key = (await api.create_key({"id": user_id, "username": "bench"})).key
+        names = list(api.COMMODITIES)
+        snapshots = await api.get_price_snapshots(names)
+
+        cases = build_cases(api_key, names, snapshots)
+        selected = [name.strip() for name in args.cases.split(",") if name.strip()] if args.cases else list(cases)
+        unknown = set(selected) - set(cases)
+        if unknown:
+            raise SystemExit(f"unknown case(s): {', '.join(sorted(unknown))}")
+
+        for name in selected:
+            func, is_async, divisor = cases[name]
+            iterations = max(1, args.iterations // divisor)
+            ns_per_op = await measure(func, iterations, args.repeat, is_async)
+            results[name] = {"iterations": iterations, "repeat": args.repeat, "ns_per_op": round(ns_per_op, 1)}
+            print(f"{name:<28} {ns_per_op / 1000:10.2f} us/op  ({iterations} x {args.repeat})")
+
+    if args.json:
+        harness.write_results(args.json, "micro", args, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cases", help="comma-separated subset of cases to run")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    asyncio.run(main(parser.parse_args()))
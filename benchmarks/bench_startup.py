@@ -0,0 +1,139 @@
+"""
+Cold-start benchmark: how long `import api` takes, and how long a fresh uvicorn process takes to answer
+its first successful /gold.
+
+Each run starts `uvicorn api:app` in a new process (offline price provider, shared temporary database
+with one pre-created API key) and polls /gold until it returns 200. Runs are repeated with the startup
+price warm-up on (default) and off (PRICE_WARMUP_TIMEOUT_SECONDS=0), where the first request pays the
+fetch itself.
+
+Cases:
+  import_api           wall time of `import api` in a fresh interpreter
+  first_gold_warmup    process start -> first 200 from /gold, cache warmed during startup
+  first_gold_no_warmup process start -> first 200 from /gold, cache filled by that request
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--json results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import harness
+
+POLL_INTERVAL_SECONDS = 0.005
+STARTUP_TIMEOUT_SECONDS = 60
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=harness.REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def request(port, method, path, headers=None, data=None):
+    """Returns (status, parsed JSON body or None); connection errors count as status None."""
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=5) as response:
+            return response.status, json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None, None
+
+
+def wait_for(port, deadline, method, path, **kwargs):
+    while time.monotonic() < deadline:
+        status, body = request(port, method, path, **kwargs)
+        if status is not None and 200 <= status < 300:
+            return body
+        time.sleep(POLL_INTERVAL_SECONDS)
+    raise SystemExit(f"server did not answer {method} {path} within {STARTUP_TIMEOUT_SECONDS}s")
+
+
+def create_api_key(env):
+    """Starts the app once to create the schema, a user and an API key in the shared database."""
+    port = free_port()
+    server = start_server(port, env)
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+        wait_for(port, deadline, "GET", "/commodities")
+        request(
+            port, "POST", "/register", headers={"Content-Type": "application/json"},
+            data=json.dumps({"username": "bench", "password": "bench-password"}).encode()
+        )
+        token = wait_for(
+            port, deadline, "POST", "/login", headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data=b"username=bench&password=bench-password"
+        )["access_token"]
+        return wait_for(port, deadline, "POST", "/api-keys", headers={"Authorization": f"Bearer {token}"})["key"]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def time_first_gold(env, api_key):
+    port = free_port()
+    started = time.perf_counter()
+    server = start_server(port, env)
+    try:
+        wait_for(port, time.monotonic() + STARTUP_TIMEOUT_SECONDS, "GET", "/gold", headers={"api-key": api_key})
+        return (time.perf_counter() - started) * 1000
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def time_import(env):
+    code = "import time; started = time.perf_counter(); import api; print((time.perf_counter() - started) * 1000)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=harness.REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        "runs": len(samples),
+        "min_ms": round(min(samples), 2),
+        "median_ms": round(statistics.median(samples), 2),
+        "max_ms": round(max(samples), 2),
+    }
+
+
+def main(args):
+    env = dict(os.environ)
+    api_key = create_api_key(env)
+    cases = {
+        "import_api": lambda: time_import(env),
+        "first_gold_warmup": lambda: time_first_gold(env, api_key),
+        "first_gold_no_warmup": lambda: time_first_gold({**env, "PRICE_WARMUP_TIMEOUT_SECONDS": "0"}, api_key),
+    }
+    results = {}
+    for name, run in cases.items():
+        results[name] = summarize([run() for _ in range(args.repeat)])
+        summary = results[name]
+        print(f"{name:<22} median {summary['median_ms']:9.2f} ms  min {summary['min_ms']:9.2f} ms  max {summary['max_ms']:9.2f} ms")
+
+    if args.json:
+        harness.write_results(args.json, "startup", args, results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    main(parser.parse_args())
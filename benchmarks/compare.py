@@ -0,0 +1,62 @@
+"""
+Compares two result files written with --json by bench_api.py, bench_micro.py or bench_startup.py (e.g. main
+vs. a branch)
+and flags regressions larger than --threshold percent. Exits with status 1 if any metric regressed.
+
+Usage:
+    python benchmarks/compare.py baseline.json candidate.json [--threshold 10]
+"""
+import argparse
+import json
+import sys
+
+# metric -> True if higher is better
+METRICS = {
+    "throughput_rps": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "ns_per_op": False,
+    "median_ms": False,
+}
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    for name in sorted(set(baseline["results"]) & set(candidate["results"])):
+        before, after = baseline["results"][name], candidate["results"][name]
+        for metric, higher_is_better in METRICS.items():
+            if metric not in before or metric not in after or not before[metric]:
+                continue
+            change = (after[metric] - before[metric]) / before[metric] * 100
+            regressed = change < -threshold if higher_is_better else change > threshold
+            marker = "  REGRESSION" if regressed else ""
+            print(f"{name:<28} {metric:<15} {before[metric]:>12.2f} -> {after[metric]:>12.2f}  {change:+7.1f}%{marker}")
+            if regressed:
+                regressions.append((name, metric, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent before flagging")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    if baseline["benchmark"] != candidate["benchmark"]:
+        raise SystemExit(f"can't compare a '{baseline['benchmark']}' run with a '{candidate['benchmark']}' run")
+    print(f"baseline {baseline['meta'].get('git_revision')}  vs  candidate {candidate['meta'].get('git_revision')}")
+    regressions = compare(baseline, candidate, args.threshold)
+    print(f"{len(regressions)} regression(s) beyond {args.threshold}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
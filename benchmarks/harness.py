@@ -0,0 +1,68 @@
+"""
+Shared helpers for the benchmark scripts: an isolated app environment, latency summaries and
+machine-readable result files.
+
+Import this before api: it points the app at a temporary database and the offline price provider, and
+quiets its logging.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix="goldprice-bench-")
+os.environ.setdefault("API_KEYS_DB_PATH", os.path.join(WORK_DIR, "api_keys.db"))
+os.environ.setdefault("PRICE_PROVIDERS", "offline")
+os.environ.setdefault("LOG_LEVEL", "WARNING") # Keep the app's log lines out of the reports
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize_latencies(latencies_ms, elapsed_seconds):
+    """Throughput and latency distribution for one load-test scenario."""
+    return {
+        "requests": len(latencies_ms),
+        "elapsed_seconds": round(elapsed_seconds, 4),
+        "throughput_rps": round(len(latencies_ms) / elapsed_seconds, 2) if elapsed_seconds else None,
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 3),
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+        "max_ms": round(max(latencies_ms), 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def write_results(path, benchmark, args, results):
+    """Writes {"benchmark", "meta", "results"} as JSON so runs from different versions can be compared."""
+    document = {
+        "benchmark": benchmark,
+        "meta": {
+            "timestamp": time.time(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+    print(f"results written to {path}")
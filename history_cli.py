@@ -0,0 +1,361 @@
+"""
+Bulk loading and export of price history for the instruments in api.COMMODITIES.
+
+backfill streams OHLC bars from yfinance or from local CSV/Parquet files into price_bars. Bars are
+written in chunks, one executemany transaction per chunk. Each bar goes in at its own resolution. Every
+coarser resolution bucket the chunk touched is then recomputed from the stored finer bars, so re-loading
+a range gives the same result. Each chunk also records how far its input got (history_backfill_progress),
+so an interrupted run picks up after the last committed chunk. Input must be in time order per symbol.
+
+export streams stored bars out as CSV, JSON lines or Parquet, fetching from SQLite in chunks.
+
+Usage:
+    python history_cli.py backfill yfinance --symbols gold,silver,palladium --interval 1d --start 2015-01-01
+    python history_cli.py backfill csv gold.csv --symbol gold --interval 1h
+    python history_cli.py backfill parquet bars.parquet --interval 1d   (a "symbol" column picks the instrument)
+    python history_cli.py export --symbols gold --resolution 1d --format csv --output gold-1d.csv
+
+CSV/Parquet columns (case-insensitive): time (Unix seconds or ISO 8601, UTC if no offset; "timestamp",
+"date" and "datetime" also work), open, high, low, close, and optionally symbol. Parquet needs pyarrow.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import api
+
+CHUNK_ROWS = 50000
+# Longest range Yahoo serves per request at each interval; longer backfills are split into windows
+YFINANCE_WINDOW_DAYS = {"1m": 7, "5m": 59, "1h": 729, "1d": 3650}
+TIME_COLUMNS = ("time", "timestamp", "datetime", "date")
+EXPORT_COLUMNS = ("symbol", "resolution", "bucket_start", "time", "open", "high", "low", "close", "ticks")
+
+
+def resolve_ticker(symbol: str) -> str:
+    """Maps a registry name ("gold") or ticker ("GC=F") to the ticker, exiting on unknown instruments."""
+    if symbol.lower() in api.COMMODITIES:
+        return api.COMMODITIES[symbol.lower()]["symbol"]
+    if symbol.upper() in api.SYMBOL_TO_COMMODITY:
+        return symbol.upper()
+    raise SystemExit(f"Unknown instrument '{symbol}'. Known: {', '.join(api.COMMODITIES)}")
+
+
+def parse_time(value) -> float:
+    if isinstance(value, datetime):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+    if hasattr(value, "to_pydatetime"): # pandas Timestamp
+        return parse_time(value.to_pydatetime())
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        return parse_time(datetime.fromisoformat(text.replace("Z", "+00:00")))
+
+
+def normalize_row(row: dict, default_ticker: str) -> tuple:
+    """(ticker, bucket time, open, high, low, close) from a CSV/Parquet record with case-insensitive columns."""
+    row = {str(key).strip().lower(): value for key, value in row.items()}
+    time_column = next((column for column in TIME_COLUMNS if column in row), None)
+    if time_column is None:
+        raise SystemExit(f"Input has no time column (one of: {', '.join(TIME_COLUMNS)})")
+    ticker = resolve_ticker(row["symbol"]) if row.get("symbol") else default_ticker
+    if ticker is None:
+        raise SystemExit("Input has no symbol column; pass --symbol")
+    return (ticker, parse_time(row[time_column]), float(row["open"]), float(row["high"]), float(row["low"]), float(row["close"]))
+
+
+# --- Input streams: each yields (ticker, timestamp, open, high, low, close) in time order per ticker ---
+
+def read_csv(path: str, ticker: str):
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield normalize_row(row, ticker)
+
+
+def read_parquet(path: str, ticker: str):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet input needs pyarrow (pip install pyarrow)")
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=CHUNK_ROWS):
+        for row in batch.to_pylist():
+            yield normalize_row(row, ticker)
+
+
+def read_yfinance(tickers: list, interval: str, start: datetime, end: datetime, resume_from: dict):
+    """Downloads each ticker window by window, so only one window of bars is in memory at a time. A resumed
+    ticker starts at its last committed bar instead of at start, so finished windows aren't downloaded again."""
+    window = timedelta(days=YFINANCE_WINDOW_DAYS[interval])
+    for ticker in tickers:
+        window_start = start
+        if ticker in resume_from:
+            window_start = max(start, datetime.fromtimestamp(resume_from[ticker], timezone.utc))
+        while window_start < end:
+            window_end = min(window_start + window, end)
+            data = api.yf.download(
+                ticker, start=window_start, end=window_end, interval=interval, progress=False, auto_adjust=False
+            )
+            if not data.empty:
+                if hasattr(data.columns, "levels"): # Newer yfinance keeps a (field, ticker) column index
+                    data = data.xs(ticker, axis=1, level=-1)
+                for stamp, bar in data.dropna(subset=["Open", "High", "Low", "Close"]).iterrows():
+                    yield (ticker, parse_time(stamp), float(bar["Open"]), float(bar["High"]), float(bar["Low"]), float(bar["Close"]))
+            window_start = window_end
+
+
+# --- Backfill ---
+
+def coarser_resolutions(resolution: str) -> list:
+    width = api.HISTORY_RESOLUTIONS[resolution]
+    return [name for name, other in api.HISTORY_RESOLUTIONS.items() if other > width]
+
+
+def _recompute_rollups(conn, ticker: str, resolution: str, first: float, last: float):
+    """Rebuilds the coarser bars covering [first, last] from the stored bars at resolution."""
+    for coarse in coarser_resolutions(resolution):
+        start = api.bucket_start(first, coarse)
+        end = api.bucket_start(last, coarse) + api.HISTORY_RESOLUTIONS[coarse]
+        rows = conn.execute(
+            '''
+            SELECT bucket_start, open, high, low, close, tick_count FROM price_bars
+            WHERE symbol = ? AND resolution = ? AND bucket_start >= ? AND bucket_start < ?
+            ORDER BY bucket_start
+            ''',
+            (ticker, resolution, start, end)
+        )
+        bars = {}
+        for row in rows:
+            bucket = api.bucket_start(row["bucket_start"], coarse)
+            bar = bars.get(bucket)
+            if bar is None:
+                bars[bucket] = [row["open"], row["high"], row["low"], row["close"], row["tick_count"]]
+            else:
+                bar[1] = max(bar[1], row["high"])
+                bar[2] = min(bar[2], row["low"])
+                bar[3] = row["close"]
+                bar[4] += row["tick_count"]
+        conn.executemany(
+            "INSERT OR REPLACE INTO price_bars (symbol, resolution, bucket_start, open, high, low, close, tick_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(ticker, coarse, bucket, *bar) for bucket, bar in bars.items()]
+        )
+
+
+def _write_chunk(conn, chunk: list, resolution: str, jobs: dict):
+    """Writes one chunk of bars, their rollups and the jobs' resume points in a single transaction."""
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO price_bars (symbol, resolution, bucket_start, open, high, low, close, tick_count) VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+            [(ticker, resolution, bucket, open_, high, low, close) for ticker, bucket, open_, high, low, close in chunk]
+        )
+        ranges = {}
+        for ticker, bucket, *_ in chunk:
+            first, last = ranges.get(ticker, (bucket, bucket))
+            ranges[ticker] = (min(first, bucket), max(last, bucket))
+        for ticker, (first, last) in ranges.items():
+            _recompute_rollups(conn, ticker, resolution, first, last)
+        conn.executemany(api.HISTORY_VERSION_BUMP_SQL, [(ticker,) for ticker in ranges]) # Running servers drop stale analytics
+        now = time.time()
+        conn.executemany(
+            '''
+            INSERT INTO history_backfill_progress (job, last_timestamp, rows_loaded, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (job) DO UPDATE SET
+                last_timestamp = excluded.last_timestamp,
+                rows_loaded = rows_loaded + excluded.rows_loaded,
+                updated_at = excluded.updated_at
+            ''',
+            [(job, last_timestamp, rows, now) for job, (last_timestamp, rows) in jobs.items()]
+        )
+
+
+def load_resume_points(source: str, resolution: str, restart: bool) -> dict:
+    """{ticker: timestamp of the last committed bar} for a backfill job; clears them first with restart."""
+    api.init_db()
+    job_prefix = f"{source}:{resolution}:"
+    with api.db_pool.connection() as conn:
+        if restart:
+            with conn:
+                conn.execute("DELETE FROM history_backfill_progress WHERE job LIKE ?", (job_prefix + "%",))
+        resume_from = {
+            row["job"][len(job_prefix):]: row["last_timestamp"]
+            for row in conn.execute("SELECT job, last_timestamp FROM history_backfill_progress WHERE job LIKE ?", (job_prefix + "%",))
+        }
+    for ticker, last_timestamp in resume_from.items():
+        print(f"{ticker}: resuming after {datetime.fromtimestamp(last_timestamp, timezone.utc).isoformat()}", file=sys.stderr)
+    return resume_from
+
+
+def backfill(bars, source: str, resolution: str, resume_from: dict, chunk_rows: int) -> int:
+    """Loads (ticker, timestamp, o, h, l, c) bars in chunks, skipping those at or before each ticker's resume
+    point (see load_resume_points); returns the number of bars written."""
+    api.init_db()
+    job_prefix = f"{source}:{resolution}:"
+    with api.db_pool.connection() as conn:
+        written = skipped = 0
+        chunk, jobs, last_seen = [], {}, {}
+        for ticker, timestamp, open_, high, low, close in bars:
+            if timestamp < last_seen.get(ticker, float("-inf")):
+                raise SystemExit(f"{ticker}: input is not in time order at {timestamp}; resuming would skip bars")
+            last_seen[ticker] = timestamp
+            if timestamp <= resume_from.get(ticker, float("-inf")):
+                skipped += 1
+                continue
+            chunk.append((ticker, api.bucket_start(timestamp, resolution), open_, high, low, close))
+            last_timestamp, rows = jobs.get(job_prefix + ticker, (timestamp, 0))
+            jobs[job_prefix + ticker] = (max(last_timestamp, timestamp), rows + 1)
+            if len(chunk) >= chunk_rows:
+                _write_chunk(conn, chunk, resolution, jobs)
+                written += len(chunk)
+                print(f"{written} bars written", file=sys.stderr)
+                chunk, jobs = [], {}
+        if chunk:
+            _write_chunk(conn, chunk, resolution, jobs)
+            written += len(chunk)
+    print(f"done: {written} bars written, {skipped} already loaded", file=sys.stderr)
+    return written
+
+
+# --- Export ---
+
+def iter_bars(tickers: list, resolution: str, start, end, chunk_rows: int):
+    """Yields stored bars as dicts, oldest first, fetching chunk_rows at a time."""
+    with api.db_pool.connection() as conn:
+        for ticker in tickers:
+            cursor = conn.execute(
+                '''
+                SELECT symbol, resolution, bucket_start, open, high, low, close, tick_count FROM price_bars
+                WHERE symbol = ? AND resolution = ? AND bucket_start >= ? AND bucket_start <= ?
+                ORDER BY bucket_start
+                ''',
+                (ticker, resolution, start if start is not None else float("-inf"), end if end is not None else float("inf"))
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {
+                        "symbol": row["symbol"],
+                        "resolution": row["resolution"],
+                        "bucket_start": row["bucket_start"],
+                        "time": datetime.fromtimestamp(row["bucket_start"], timezone.utc).isoformat(),
+                        "open": row["open"],
+                        "high": row["high"],
+                        "low": row["low"],
+                        "close": row["close"],
+                        "ticks": row["tick_count"],
+                    }
+
+
+def export(bars, fmt: str, output: str, chunk_rows: int) -> int:
+    count = 0
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        if output == "-":
+            raise SystemExit("Parquet output needs --output")
+        writer = None
+        batch = []
+        try:
+            for bar in bars:
+                batch.append(bar)
+                if len(batch) >= chunk_rows:
+                    table = pa.Table.from_pylist(batch)
+                    writer = writer or pq.ParquetWriter(output, table.schema)
+                    writer.write_table(table)
+                    count += len(batch)
+                    batch = []
+            if batch or writer is None:
+                table = pa.Table.from_pylist(batch) if batch else pa.Table.from_pylist([], schema=pa.schema(
+                    [(column, pa.float64()) for column in EXPORT_COLUMNS]
+                ))
+                writer = writer or pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+                count += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
+
+    f = sys.stdout if output == "-" else open(output, "w", newline="")
+    try:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            for bar in bars:
+                writer.writerow(bar)
+                count += 1
+        else:
+            for bar in bars:
+                f.write(json.dumps(bar) + "\n")
+                count += 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return count
+
+
+def parse_date(value: str) -> datetime:
+    stamp = parse_time(value)
+    return datetime.fromtimestamp(stamp, timezone.utc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="bars per transaction / fetch")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("backfill", help="bulk-load bars into price_bars")
+    load.add_argument("source", choices=("yfinance", "csv", "parquet"))
+    load.add_argument("path", nargs="?", help="input file (csv/parquet)")
+    load.add_argument("--symbol", help="instrument for files without a symbol column (name or ticker)")
+    load.add_argument("--symbols", default=",".join(api.COMMODITIES), help="instruments to download (yfinance)")
+    load.add_argument("--interval", default="1d", choices=tuple(api.HISTORY_RESOLUTIONS), help="bar width of the input")
+    load.add_argument("--start", help="first date to download (yfinance, default: 5 years ago)")
+    load.add_argument("--end", help="last date to download (yfinance, default: now)")
+    load.add_argument("--restart", action="store_true", help="ignore saved progress and load from the beginning")
+
+    dump = commands.add_parser("export", help="stream stored bars to a file or stdout")
+    dump.add_argument("--symbols", default=",".join(api.COMMODITIES), help="instruments (names or tickers)")
+    dump.add_argument("--resolution", default="1d", choices=tuple(api.HISTORY_RESOLUTIONS))
+    dump.add_argument("--start", help="first bucket (Unix time or ISO 8601)")
+    dump.add_argument("--end", help="last bucket (Unix time or ISO 8601)")
+    dump.add_argument("--format", default="csv", choices=("csv", "jsonl", "parquet"))
+    dump.add_argument("--output", default="-", help="output file, - for stdout (default)")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        if args.source == "yfinance":
+            tickers = [resolve_ticker(symbol.strip()) for symbol in args.symbols.split(",") if symbol.strip()]
+            end = parse_date(args.end) if args.end else datetime.now(timezone.utc)
+            start = parse_date(args.start) if args.start else end - timedelta(days=5 * 365)
+            resume_from = load_resume_points("yfinance", args.interval, args.restart)
+            bars = read_yfinance(tickers, args.interval, start, end, resume_from)
+            source = "yfinance"
+        else:
+            if not args.path:
+                raise SystemExit(f"{args.source} backfill needs an input file")
+            ticker = resolve_ticker(args.symbol) if args.symbol else None
+            bars = (read_csv if args.source == "csv" else read_parquet)(args.path, ticker)
+            source = f"{args.source}:{os.path.abspath(args.path)}"
+            resume_from = load_resume_points(source, args.interval, args.restart)
+        backfill(bars, source, args.interval, resume_from, args.chunk_rows)
+    else:
+        tickers = [resolve_ticker(symbol.strip()) for symbol in args.symbols.split(",") if symbol.strip()]
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+        count = export(iter_bars(tickers, args.resolution, start, end, args.chunk_rows), args.format, args.output, args.chunk_rows)
+        print(f"{count} bars exported", file=sys.stderr)
+    api.db_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Retry backoff after failed price refreshes.
+
+Runs against a temporary database and the offline price provider, like the benchmarks, with the
+upstream fetch replaced by one that never returns a price.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("API_KEYS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="goldprice-test-"), "api_keys.db"))
+os.environ.setdefault("PRICE_PROVIDERS", "offline")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+import api  # noqa: E402  (after the environment above)
+
+
+@pytest.fixture
+def failing_upstream(monkeypatch):
+    """Every upstream fetch comes back empty after a short delay; returns the list of fetched batches."""
+    fetches = []
+
+    async def fetch_live_prices(symbols):
+        fetches.append(list(symbols))
+        await asyncio.sleep(0.05) # Long enough for concurrent callers to join the same fetch
+        return {}, {}
+
+    monkeypatch.setattr(api, "fetch_live_prices", fetch_live_prices)
+    monkeypatch.setattr(api, "refresh_schedule", api.RefreshSchedule())
+    monkeypatch.setattr(api, "price_fetches", api.SingleFlight())
+    monkeypatch.setattr(api, "price_cache", {})
+    return fetches
+
+
+def test_concurrent_cold_callers_count_one_failure(failing_upstream):
+    async def run():
+        return await asyncio.gather(*(api.get_price_snapshots(["gold"]) for _ in range(20)))
+
+    started = time.time()
+    results = asyncio.run(run())
+
+    assert results == [{}] * 20
+    assert len(failing_upstream) == 1
+    assert api.refresh_schedule._failures == {"gold": 1}
+    retry_in = api.refresh_schedule._retry_at["gold"] - started
+    assert 0 < retry_in <= api.PRICE_REFRESH_RETRY_SECONDS + 1
+
+
+def test_backoff_grows_per_failed_fetch(failing_upstream):
+    for expected_failures in (1, 2):
+        api.refresh_schedule._retry_at.clear() # Due again, so the next cold call fetches
+        asyncio.run(api.get_price_snapshots(["gold"]))
+        assert api.refresh_schedule._failures["gold"] == expected_failures
+
+    # Still backing off: a cold call is left out at once instead of fetching again
+    asyncio.run(api.get_price_snapshots(["gold"]))
+    assert len(failing_upstream) == 2